@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+''' Compare the cost of decoding beatmapEvent frames via the fast paths and a plain json.loads '''
+
+import argparse
+import json
+import timeit
+
+from clubsaber import protocol
+
+
+FRAME = json.dumps({
+    'event': 'beatmapEvent',
+    'time': 1625097600000,
+    'beatmapEvent': {
+        'type': 2,
+        'value': 6,
+        'floatValue': 1.0,
+        'previousSameTypeEventTime': 12.5,
+        'nextSameTypeEventTime': 13.0,
+    },
+})
+
+
+def baseline(packet=FRAME):
+    ''' What Club.run used to do for every frame '''
+    data = json.loads(packet)
+    event = data.get('beatmapEvent', {})
+    return data.get('event'), event.get('type'), event.get('value')
+
+
+def fast_path(decode_map_event):
+    def decode(packet=FRAME):
+        event = protocol.sniff(packet)
+        return (event,) + decode_map_event(packet)
+    return decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=200000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    paths = (
+        ('json.loads', baseline),
+        ('sniff + scan', fast_path(protocol.scan_map_event)),
+        ('sniff + %s' % protocol.loads.__module__, fast_path(protocol.parse_map_event)),
+    )
+    assert len(set(func() for _, func in paths)) == 1
+
+    print('Club.run uses: %s' % protocol.decode_map_event.__name__)
+    for name, func in paths:
+        best = min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+        print('%-16s %8.3f us/frame' % (name, best / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+''' Drive a Club end to end against a fake game, WiZ bulbs and Hue bridge, and report
+how quickly (and how reliably) beatmap events turn into packets at the lights '''
+
+import argparse
+import asyncio
+import bisect
+import logging
+import math
+import statistics
+import time
+
+from clubsaber.bridge import HueBridge
+from clubsaber.club import Club
+from clubsaber.config import Config
+from clubsaber.light import HueLight, WizLight
+from clubsaber import metrics
+from clubsaber import wiz
+
+from fakes import FakeGame, FakeHueBridge, FakeWizBulb
+
+
+def measure(club, sent, received):
+    ''' Match each event to the first packet each of its lights received after it.
+
+    An event counts as dropped at a light if the next event for that light
+    arrived before any packet did (it was coalesced, suppressed or lost). '''
+    latencies = []
+    dropped = 0
+    for idx, light in enumerate(club.lights):
+        times = [at for at, _ in received[idx]]
+        routed = [at for at, etype, _ in sent
+                  if idx in club.config.get_light_indices_for_event(club.lights, etype)]
+
+        for n, at in enumerate(routed):
+            deadline = routed[n + 1] if n + 1 < len(routed) else math.inf
+            first = bisect.bisect_left(times, at)
+            if first < len(times) and times[first] < deadline:
+                latencies.append(times[first] - at)
+            else:
+                dropped += 1
+    return latencies, dropped
+
+
+def report(args, club, game, hue, received, elapsed):
+    latencies, dropped = measure(club, game.sent, received)
+    packets = sum(len(packets) for packets in received)
+
+    print('%d WiZ + %d Hue lights, %d events over %.1fs (%.1f/s)' % (
+        args.wiz, args.hue, len(game.sent), elapsed, len(game.sent) / elapsed))
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100)
+        print('Event -> packet latency (ms): p50 %.1f  p90 %.1f  p99 %.1f  max %.1f' % (
+            1000 * percentiles[49], 1000 * percentiles[89],
+            1000 * percentiles[98], 1000 * max(latencies)))
+    print('Delivered %d light events, dropped %d' % (len(latencies), dropped))
+    print('Packets received: %d (%.1f/s)%s' % (
+        packets, packets / elapsed,
+        ', %d refused by the bridge' % hue.refused if hue else ''))
+
+
+async def benchmark(args):
+    if args.events:
+        events = FakeGame.load(args.events)
+    else:
+        events = FakeGame.generate(args.rate, args.duration)
+
+    game = FakeGame(events)
+    await game.start()
+
+    bulbs = await FakeWizBulb.fleet(args.wiz, args.wiz_port)
+
+    hue = None
+    bridges = {}
+    if args.hue:
+        hue = FakeHueBridge(range(1, args.hue + 1), latency=args.hue_latency, rate=args.hue_rate)
+        await hue.start()
+        bridges['bench'] = {'ip': hue.ip, 'username': 'bench'}
+
+    config = Config(
+        uri = game.uri,
+        wiz_port = args.wiz_port,
+        wiz_fire_and_forget = args.fire_and_forget,
+        light_shards = args.shards,
+        bridges = bridges,
+        rediscover_interval = 0,
+        lights_ignored = [],
+        light_event_map = {},
+    )
+    club = Club(config)
+
+    lights = [WizLight(bulb.ip, bulb.mac, config) for bulb in bulbs]
+    received = [bulb.received for bulb in bulbs]
+    if hue:
+        bridge = HueBridge('bench', hue.ip, 'bench', config)
+        bridge.set_groups(hue.info())
+        club.bridges[bridge.id] = bridge
+        lights += [HueLight(id, bridge, config) for id in hue.lights]
+        received += [hue.received[id] for id in hue.lights]
+
+    if args.metrics:
+        metrics.enable()
+
+    club.build_palettes()
+    club.set_lights(lights)
+    club.renderer.start()
+    await club._init_game()
+
+    start = time.perf_counter()
+    running = asyncio.create_task(club.run())
+    await game.finished.wait()
+    elapsed = time.perf_counter() - start
+
+    # Let the last envelopes play out
+    await asyncio.sleep(args.settle)
+
+    running.cancel()
+    club.renderer.stop()
+    if club.shards:
+        # Give the workers a moment to report, then shut them down
+        await asyncio.sleep(1.5)
+        club.shards.close()
+    await club.game.close()
+    await game.stop()
+    if hue:
+        await bridge.close()
+        await hue.stop()
+
+    print()
+    report(args, club, game, hue, received, elapsed)
+    if args.metrics:
+        print(metrics.summary())
+    if args.verbose:
+        club.report_lights()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-w', '--wiz', type=int, default=8, help='Number of fake WiZ bulbs')
+    parser.add_argument('-u', '--hue', type=int, default=4, help='Number of fake Hue lights')
+    parser.add_argument('-r', '--rate', type=float, default=20.0, help='Events per second')
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='Seconds of events')
+    parser.add_argument('-e', '--events',
+                        help='Replay events from a JSON-lines file instead of a steady stream')
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help='Seconds to wait for stragglers after the last event')
+    parser.add_argument('--wiz-port', type=int, default=wiz.PORT)
+    parser.add_argument('--fire-and-forget', action='store_true')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='Drive the lights from this many worker processes')
+    parser.add_argument('--hue-latency', type=float, default=0.02,
+                        help='Seconds the fake bridge takes to answer')
+    parser.add_argument('--hue-rate', type=float, default=10.0,
+                        help='Requests per second the fake bridge accepts')
+    parser.add_argument('-m', '--metrics', action='store_true',
+                        help='Also report per-stage pipeline timings')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    asyncio.run(benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
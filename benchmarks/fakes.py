@@ -0,0 +1,204 @@
+''' Local stand-ins for Beat Saber, WiZ bulbs and a Hue bridge, for benchmarking without hardware '''
+
+import asyncio
+import http
+import json
+import itertools
+import time
+
+import websockets
+
+
+class FakeGame(object):
+    ''' A websocket server which plays a stream of beatmap events to whoever connects.
+
+    events is a list of (seconds, type, value); the time each event was
+    actually sent is recorded in sent. '''
+
+    def __init__(self, events, host='127.0.0.1', port=0, bpm=120):
+        self.events = events
+        self.host = host
+        self.port = port
+        self.bpm = bpm
+
+        self.server = None
+        self.sent = []
+        self.finished = asyncio.Event()
+
+    @property
+    def uri(self):
+        return 'ws://%s:%d/socket' % (self.host, self.port)
+
+    async def start(self):
+        self.server = await websockets.serve(self._play, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _play(self, connection, *args):
+        await connection.send(json.dumps({
+            'event': 'songStart',
+            'status': {'songBPM': self.bpm, 'beatmap': {'songName': 'Benchmark'}},
+        }))
+
+        start = time.perf_counter()
+        for at, etype, value in self.events:
+            delay = start + at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.sent.append((time.perf_counter(), etype, value))
+            await connection.send(json.dumps({
+                'event': 'beatmapEvent',
+                'time': int(time.time() * 1000),
+                'beatmapEvent': {'type': etype, 'value': value},
+            }))
+
+        self.finished.set()
+        await connection.wait_closed()
+
+    @staticmethod
+    def generate(rate, duration, types=(0, 1, 2, 3, 4), values=(1, 2, 3, 5, 6, 7)):
+        ''' A steady stream of events at rate per second '''
+        count = int(rate * duration)
+        return [(idx / rate, etype, value) for idx, etype, value in
+                zip(range(count), itertools.cycle(types), itertools.cycle(values))]
+
+    @staticmethod
+    def load(filename):
+        ''' Read events from a JSON-lines file of {"time": seconds, "type": ..., "value": ...} '''
+        with open(filename) as events_file:
+            events = [json.loads(line) for line in events_file if line.strip()]
+        return [(event['time'], event['type'], event['value']) for event in events]
+
+
+class FakeWizBulb(asyncio.DatagramProtocol):
+    ''' A WiZ bulb which acknowledges (and records) every setPilot '''
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.mac = 'fa4e%08x' % sum(int(octet) << (8 * i) for i, octet in enumerate(reversed(ip.split('.'))))
+        self.transport = None
+        self.received = []
+        self.pilot = {'state': False}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        message = json.loads(data)
+        method = message.get('method')
+        if method == 'setPilot':
+            self.received.append((time.perf_counter(), message.get('params')))
+            self.pilot.update(message.get('params', {}))
+            result = {'success': True}
+        elif method == 'getPilot':
+            result = dict(self.pilot, mac=self.mac)
+        else:
+            return
+        self.transport.sendto(json.dumps({'method': method, 'result': result}).encode(), addr)
+
+    @classmethod
+    async def fleet(cls, count, port):
+        ''' Start count bulbs on 127.0.1.1, 127.0.1.2, ... (Linux routes all of 127/8 to loopback) '''
+        loop = asyncio.get_running_loop()
+        bulbs = []
+        for idx in range(count):
+            ip = '127.0.%d.%d' % (1 + idx // 250, 1 + idx % 250)
+            _, bulb = await loop.create_datagram_endpoint(lambda: cls(ip), local_addr=(ip, port))
+            bulbs.append(bulb)
+        return bulbs
+
+
+class FakeHueBridge(object):
+    ''' A minimal Hue bridge REST API with configurable latency and rate limit.
+
+    Requests beyond rate per second are refused with 429, like an overloaded bridge. '''
+
+    def __init__(self, lights, latency=0.02, rate=10.0, host='127.0.0.1', port=0):
+        self.lights = [str(light) for light in lights]
+        self.latency = latency
+        self.rate = rate
+        self.host = host
+        self.port = port
+
+        self.server = None
+        self.received = {light: [] for light in self.lights}
+        self.refused = 0
+        self.tokens = rate
+        self.refilled = time.perf_counter()
+
+    @property
+    def ip(self):
+        return '%s:%d' % (self.host, self.port)
+
+    def info(self):
+        return {
+            'lights': {light: {} for light in self.lights},
+            'groups': {'1': {'name': 'Benchmark', 'lights': list(self.lights)}},
+        }
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _allow(self):
+        now = time.perf_counter()
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                method, path, _ = request.decode().split(' ', 2)
+
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode().partition(':')
+                    if name.lower() == 'content-length':
+                        length = int(value)
+                body = json.loads(await reader.readexactly(length)) if length else None
+
+                await asyncio.sleep(self.latency)
+                status, response = self._handle(method, path, body)
+
+                data = json.dumps(response).encode()
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: %d\r\n\r\n' % (
+                                 status, http.HTTPStatus(status).phrase.encode(), len(data)) + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _handle(self, method, path, body):
+        parts = path.strip('/').split('/')
+        if method != 'PUT' or len(parts) != 5:
+            return 200, self.info()
+        if not self._allow():
+            self.refused += 1
+            return 429, [{'error': {'type': 901, 'description': 'rate limited'}}]
+
+        now = time.perf_counter()
+        _, _, kind, id, _ = parts
+        members = [id] if kind == 'lights' else self.lights
+        for light in members:
+            self.received[light].append((now, body))
+        return 200, [{'success': {path: True}}]
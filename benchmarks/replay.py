@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+''' Record a synthetic session (text, status and binary frames) and replay it flat out to virtual lights '''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+
+from clubsaber.club import Club
+from clubsaber.config import Config
+from clubsaber.light import VirtualLight
+from clubsaber.recording import Recorder, Recording, replay
+
+
+def session(events):
+    ''' The frames of a short song, with a cover on the status frames and one frame sent as binary '''
+    cover = 'A' * 64 * 1024
+    status = {'songBPM': 120, 'beatmap': {'songName': 'Replay check', 'songCover': cover}}
+
+    yield json.dumps({'event': 'hello', 'status': status})
+    yield json.dumps({'event': 'songStart', 'status': status})
+    for n in range(events):
+        yield json.dumps({'event': 'beatmapEvent',
+                          'beatmapEvent': {'type': random.randrange(5), 'value': random.randrange(8)}})
+    # Nothing in the protocol says the game must send text
+    yield json.dumps({'event': 'beatmapEvent', 'beatmapEvent': {'type': 0, 'value': 1}}).encode()
+    yield json.dumps({'event': 'finished', 'status': status})
+
+
+async def run(args):
+    club = Club(Config(light_event_map = {}))
+    club.set_lights([VirtualLight('virtual-%d' % idx, club.config) for idx in range(args.lights)])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'session.rec')
+        recorder = Recorder(path)
+        for packet in session(args.events):
+            recorder.record(packet)
+        recorder.close()
+
+        with Recording(path) as recording:
+            frames, elapsed = await replay(club, recording, speed = 0)
+        # Let the status handlers finish
+        await asyncio.sleep(0.1)
+
+    handlers = club.supervisor.stats()
+    print('Replayed %d frames in %.3fs (%.1f us/frame); handlers: %s' % (
+        frames, elapsed, elapsed / frames * 1e6, handlers))
+    assert frames == args.events + 4, 'lost frames on the way through the recording'
+    assert not handlers['failed'], 'handlers failed during replay'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--events', type=int, default=10000)
+    parser.add_argument('-l', '--lights', type=int, default=8)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
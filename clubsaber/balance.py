@@ -0,0 +1,147 @@
+''' Spreading busy event types over more bulbs.
+
+Routing sends each event type to a fixed set of lights, so a busy type can
+hammer the same few bulbs while others idle. With balancing on, each event
+goes to only balance_width of the lights it is routed to, picked in turn
+('round_robin') or by whichever was used longest ago ('least_recent'),
+skipping any bulb which is out of its light_rates budget. An OFF goes to every
+light the type has lit since, so nothing is left on.
+
+A plan, worked out from a map's event histogram, can further narrow each
+type to its own share of the lights ahead of time. '''
+
+import math
+import time
+
+from .beatsaber import LightValue
+from .ratelimit import TokenBucket
+
+
+MODES = ('round_robin', 'least_recent')
+
+
+class Balancer(object):
+    def __init__(self, mode='round_robin', width=1, rates=None, burst=2):
+        if mode not in MODES:
+            raise ValueError('Unknown balance mode %r; expected one of %s' % (mode, MODES))
+        self.mode = mode
+        self.width = width
+        self.rates = rates or {}
+        self.burst = burst
+
+        # Event type -> light IDs it may use
+        self.plan = {}
+
+        self.now = 0.0
+        self.cursors = {}
+        self.used = {}
+        self.lit = {}
+        self.buckets = {}
+
+        self.over_budget = 0
+
+    @classmethod
+    def from_config(cls, config):
+        ''' The balancer config asks for, or None if balancing is off '''
+        mode = config.get('balance')
+        if not mode:
+            return None
+        return cls(mode, config.get('balance_width'), config.get('light_rates'), config.get('light_burst'))
+
+    def fork(self):
+        ''' A fresh balancer with the same settings and plan '''
+        balancer = Balancer(self.mode, self.width, self.rates, self.burst)
+        balancer.plan = self.plan
+        return balancer
+
+    def describe(self):
+        return [self.mode, self.width, self.rates, self.burst,
+                sorted([etype, ids] for etype, ids in self.plan.items())]
+
+    def _bucket(self, light):
+        id = light.get_id()
+        if id not in self.buckets:
+            rate = self.rates.get(id)
+            self.buckets[id] = TokenBucket(rate, self.burst, clock=lambda: self.now) if rate else None
+        return self.buckets[id]
+
+    def choose(self, etype, value, indices, lights, now=None):
+        ''' Which of the routed light indices an event should go to '''
+        self.now = time.monotonic() if now is None else now
+        if not indices:
+            return indices
+
+        lit = self.lit.setdefault(etype, set())
+        if value == LightValue.OFF:
+            chosen = tuple(idx for idx in indices if lights[idx] in lit)
+            lit.clear()
+            return chosen
+
+        planned = self.plan.get(etype)
+        if planned:
+            indices = tuple(idx for idx in indices if lights[idx].get_id() in planned) or indices
+
+        if self.mode == 'round_robin':
+            cursor = self.cursors.get(etype, 0) % len(indices)
+            order = indices[cursor:] + indices[:cursor]
+            self.cursors[etype] = cursor + 1
+        else:
+            order = sorted(indices, key=lambda idx: self.used.get(lights[idx], -math.inf))
+
+        chosen = []
+        for idx in order:
+            bucket = self._bucket(lights[idx])
+            if bucket is None or not bucket.delay():
+                chosen.append(idx)
+                if len(chosen) >= self.width:
+                    break
+
+        if not chosen:
+            # Everyone is over budget; overload whoever frees up soonest rather than go dark
+            self.over_budget += 1
+            chosen = [min(order, key=lambda idx: self._bucket(lights[idx]).delay())]
+
+        for idx in chosen:
+            light = lights[idx]
+            bucket = self._bucket(light)
+            if bucket is not None:
+                bucket.tokens -= 1
+            self.used[light] = self.now
+            lit.add(light)
+        return tuple(chosen)
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'planned_types': len(self.plan),
+            'over_budget': self.over_budget,
+        }
+
+
+def plan(counts, duration, light_ids, rates=None):
+    ''' Give each event type a share of the lights in proportion to how busy it is.
+
+    counts maps event type to how many times it occurs over duration seconds.
+    Types are placed busiest first, each on the lights with the most budget
+    left (relative to their light_rates, if known). Returns type -> light IDs. '''
+    rates = rates or {}
+    light_ids = list(light_ids)
+    total = sum(counts.values())
+    if not light_ids or not total:
+        return {}
+
+    default_rate = max(rates.values(), default=1.0)
+    capacity = {id: rates.get(id) or default_rate for id in light_ids}
+    load = {id: 0.0 for id in light_ids}
+
+    assignment = {}
+    for etype, count in sorted(counts.items(), key=lambda item: -item[1]):
+        share = max(1, min(len(light_ids), round(len(light_ids) * count / total)))
+        rate = count / duration / share if duration else 0.0
+
+        chosen = sorted(light_ids, key=lambda id: (load[id] + rate) / capacity[id])[:share]
+        for id in chosen:
+            load[id] += rate
+        assignment[etype] = chosen
+
+    return assignment
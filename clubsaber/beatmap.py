@@ -0,0 +1,131 @@
+''' Beatmap difficulties, loaded straight into NumPy columns.
+
+Both the v2 (_events, _notes) and v3 (basicBeatmapEvents, colorNotes,
+bombNotes) layouts are understood; v3's light event box groups are not.
+Parsed columns are cached as .npz in the user cache dir, keyed by a hash of
+the file, so loading a map the second time is just reading a few arrays. '''
+
+import hashlib
+import os
+
+import appdirs
+import numpy as np
+
+from . import logger
+from .beatsaber import EventType, LightValue
+from .protocol import loads
+
+
+# v2 note types; v3 colorNotes use the same 0 (left) and 1 (right) colors
+BOMB = 3
+
+_columns = ('event_times', 'event_types', 'event_values',
+            'note_times', 'note_types', 'note_directions')
+
+
+class Beatmap(object):
+    ''' Events and notes as parallel arrays, sorted by time (in beats) '''
+
+    def __init__(self, event_times, event_types, event_values,
+                 note_times, note_types, note_directions):
+        order = np.argsort(event_times, kind='stable')
+        self.event_times = np.asarray(event_times, dtype=np.float64)[order]
+        self.event_types = np.asarray(event_types, dtype=np.int32)[order]
+        self.event_values = np.asarray(event_values, dtype=np.int64)[order]
+
+        order = np.argsort(note_times, kind='stable')
+        self.note_times = np.asarray(note_times, dtype=np.float64)[order]
+        self.note_types = np.asarray(note_types, dtype=np.int32)[order]
+        self.note_directions = np.asarray(note_directions, dtype=np.int32)[order]
+
+    @classmethod
+    def load(cls, path):
+        ''' Load a difficulty file, from the cache if we've seen this exact file before '''
+        with open(path, 'rb') as beatmap_file:
+            data = beatmap_file.read()
+
+        key = hashlib.sha256(data).hexdigest()
+        cache = os.path.join(appdirs.user_cache_dir('club-saber'), 'beatmaps', key + '.npz')
+        try:
+            with np.load(cache) as columns:
+                return cls(*(columns[name] for name in _columns))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('Reparsing %s; cached copy unreadable: %s', path, e)
+
+        beatmap = cls.parse(loads(data))
+        try:
+            os.makedirs(os.path.dirname(cache), exist_ok=True)
+            np.savez(cache, **{name: getattr(beatmap, name) for name in _columns})
+        except OSError as e:
+            logger.warning('Failed to cache %s: %s', path, e)
+        return beatmap
+
+    @classmethod
+    def parse(cls, beatmap):
+        ''' Build from a decoded difficulty file of either format '''
+        if '_events' in beatmap or '_notes' in beatmap:
+            events = beatmap.get('_events', [])
+            notes = beatmap.get('_notes', [])
+            return cls(
+                [event.get('_time', 0) for event in events],
+                [event.get('_type', 0) for event in events],
+                [event.get('_value', 0) for event in events],
+                [note.get('_time', 0) for note in notes],
+                [note.get('_type', 0) for note in notes],
+                [note.get('_cutDirection', 0) for note in notes])
+
+        events = beatmap.get('basicBeatmapEvents', [])
+        notes = beatmap.get('colorNotes', [])
+        bombs = beatmap.get('bombNotes', [])
+        return cls(
+            [event.get('b', 0) for event in events],
+            [event.get('et', 0) for event in events],
+            [event.get('i', 0) for event in events],
+            [note.get('b', 0) for note in notes] + [bomb.get('b', 0) for bomb in bombs],
+            [note.get('c', 0) for note in notes] + [BOMB] * len(bombs),
+            [note.get('d', 0) for note in notes] + [0] * len(bombs))
+
+    def __len__(self):
+        return len(self.event_times)
+
+    def index(self, beat):
+        ''' Position of the first event at or after beat '''
+        return int(np.searchsorted(self.event_times, beat, side='left'))
+
+    def events(self, start=0.0, seconds_per_beat=None):
+        ''' (time, type, value) for each event from start (in beats) on, in seconds if given seconds_per_beat '''
+        first = self.index(start)
+        times = self.event_times[first:]
+        if seconds_per_beat is not None:
+            times = times * seconds_per_beat
+        return list(zip(times.tolist(), self.event_types[first:].tolist(),
+                        self.event_values[first:].tolist()))
+
+    def histogram(self):
+        ''' How many events there are of each type '''
+        types, counts = np.unique(self.event_types, return_counts=True)
+        return dict(zip(types.tolist(), counts.tolist()))
+
+    def emulate(self, rng=None):
+        ''' Make up light events from the notes, for maps which come without any '''
+        if rng is None:
+            rng = np.random.default_rng()
+        count = len(self.note_times)
+
+        # Mostly the lasers on the side each note is cut towards, sometimes another light
+        lasers = np.where(self.note_directions % 2 == 0,
+                          int(EventType.LEFT_LASERS), int(EventType.RIGHT_LASERS))
+        others = rng.choice([int(EventType.BACK_LASERS), int(EventType.RING_LIGHTS),
+                             int(EventType.ROAD_LIGHTS), int(EventType.BOOST_LIGHTS)], count)
+        types = np.where(rng.random(count) < 0.666, lasers, others)
+
+        blues = rng.choice([int(LightValue.BLUE_ON), int(LightValue.BLUE_FLASH),
+                            int(LightValue.BLUE_FADE)], count)
+        reds = rng.choice([int(LightValue.RED_ON), int(LightValue.RED_FLASH),
+                           int(LightValue.RED_FADE)], count)
+        values = np.where(self.note_types == 0, blues, reds)
+
+        return Beatmap(self.note_times, types, values,
+                       self.note_times, self.note_types, self.note_directions)
@@ -0,0 +1,256 @@
+import asyncio
+import time
+
+import httpx
+
+from . import logger
+from .queue import CommandQueue
+from .ratelimit import TokenBucket
+
+
+class HueBridge(object):
+    ''' A Hue bridge, along with the groups of lights it knows about.
+
+    Bridges rate-limit individual light calls hard, so when several of our
+    lights on one bridge are given the same state in a frame, a group that
+    covers them is set with a single call instead.
+
+    Requests share one keep-alive HTTP client, with only as many in flight
+    as the bridge tolerates. If a bridge keeps timing out or failing, its
+    circuit breaker opens and updates to it are shed until the cooldown has
+    passed and a probe request gets through again.
+
+    The bridge's command rate is shared by all its lights, so their
+    light_rates add up to one budget that every call, light or group, draws
+    on. '''
+
+    def __init__(self, id, ip, user, config):
+        self.id = id
+        self.ip = ip
+        self.user = user
+
+        self.timeout = config.get('hue_timeout')
+        self.max_inflight = config.get('hue_max_inflight')
+        self.failure_threshold = config.get('hue_breaker_threshold')
+        self.cooldown = config.get('hue_breaker_cooldown')
+
+        # Light IDs -> group ID, for every group on the bridge
+        self.groups = {}
+        self.group_queues = {}
+
+        self.client = None
+        self.inflight = asyncio.Semaphore(self.max_inflight)
+
+        # Light ID -> its share of the bridge's rate
+        self.rates = {}
+        self.burst = config.get('light_burst')
+        self.limiter = None
+
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+        self.group_actions = 0
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.shed = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    @classmethod
+    def from_description(cls, id, description, config):
+        ''' Recreate a bridge from describe(); None if we no longer have credentials for it '''
+        bridge_config = config.get('bridges', {}).get(id)
+        if not bridge_config or 'username' not in bridge_config:
+            return None
+
+        bridge = cls(id, description['ip'], bridge_config['username'], config)
+        bridge.groups = {frozenset(members): group_id
+                         for members, group_id in description.get('groups', [])}
+        return bridge
+
+    def describe(self):
+        return {
+            'ip': self.ip,
+            'groups': [[sorted(members), group_id] for members, group_id in self.groups.items()],
+        }
+
+    @property
+    def url(self):
+        return 'http://%s/api/%s' % (self.ip, self.user)
+
+    def set_groups(self, bridge_info):
+        ''' Learn the bridge's groups from its full info dump '''
+        groups = {}
+
+        # Group 0 is special: it always holds every light the bridge knows of
+        all_lights = frozenset(bridge_info.get('lights', {}).keys())
+        if all_lights:
+            groups[all_lights] = '0'
+
+        for group_id, group_info in bridge_info.get('groups', {}).items():
+            members = frozenset(group_info.get('lights', []))
+            if len(members) > 1:
+                groups.setdefault(members, group_id)
+
+        # Try the largest groups first so we cover the most lights per call
+        self.groups = dict(sorted(groups.items(), key=lambda item: -len(item[0])))
+
+    def _client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_inflight,
+                    max_keepalive_connections=self.max_inflight))
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def available(self):
+        ''' Whether the circuit breaker lets a request through right now '''
+        if self.failures < self.failure_threshold:
+            return True
+        # Once the cooldown is up, let a single probe through to test the waters
+        return not self.probing and time.monotonic() >= self.open_until
+
+    def set_rate(self, light_id, rate):
+        ''' Set a light's share of the bridge's rate; None to take it out of the budget '''
+        if rate:
+            self.rates[light_id] = rate
+        else:
+            self.rates.pop(light_id, None)
+        total = sum(self.rates.values())
+        self.limiter = TokenBucket(total, self.burst) if total else None
+
+    def reset(self):
+        ''' Close the circuit breaker, e.g. after deliberately overloading the bridge '''
+        self.failures = 0
+        self.open_until = 0.0
+
+    async def put(self, path, state):
+        ''' PUT state to the bridge; returns False if it was shed by the circuit breaker '''
+        if not self.available():
+            self.shed += 1
+            return False
+
+        if self.limiter is not None:
+            await self.limiter.acquire()
+
+        self.probing = self.failures >= self.failure_threshold
+        try:
+            async with self.inflight:
+                start = time.monotonic()
+                self.requests += 1
+                response = await self._client().put('%s/%s' % (self.url, path), json=state)
+                response.raise_for_status()
+        except httpx.TimeoutException:
+            self.timeouts += 1
+            self._failed()
+            raise
+        except httpx.HTTPError:
+            self.errors += 1
+            self._failed()
+            raise
+        finally:
+            self.probing = False
+
+        self._succeeded(time.monotonic() - start)
+
+        errors = [obj['error'] for obj in response.json() if 'error' in obj]
+        if errors:
+            raise RuntimeError('Bridge %s rejected %s: %s' % (self.id, path, errors))
+        return True
+
+    def _failed(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if time.monotonic() >= self.open_until:
+                logger.warning('Bridge %s is struggling; backing off for %.1fs',
+                               self.id, self.cooldown)
+            self.open_until = time.monotonic() + self.cooldown
+
+    def _succeeded(self, latency):
+        if self.failures >= self.failure_threshold:
+            logger.info('Bridge %s has recovered', self.id)
+        self.failures = 0
+
+        self.latency = latency if not self.latency else 0.9 * self.latency + 0.1 * latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'group_actions': self.group_actions,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'shed': self.shed,
+            'latency': self.latency,
+            'max_latency': self.max_latency,
+            'open': not self.available(),
+            'throttled': self.limiter.throttled if self.limiter is not None else 0,
+        }
+
+    async def set_light_state(self, light_id, state):
+        return await self.put('lights/%s/state' % light_id, state)
+
+    async def set_group_state(self, group_id, state):
+        return await self.put('groups/%s/action' % group_id, state)
+
+    async def _send_group(self, group_id, action):
+        payload, state, lights = action
+        if await self.set_group_state(group_id, payload) is False:
+            return False
+        # Only now do the members really show it
+        for light in lights:
+            light.sent_payload(payload, state = state)
+
+    def _group_queue(self, group_id):
+        queue = self.group_queues.get(group_id)
+        if queue is None:
+            queue = self.group_queues[group_id] = CommandQueue(
+                lambda action: self._send_group(group_id, action),
+                name='%s/groups/%s' % (self.id, group_id))
+        return queue
+
+    def dispatch(self, updates):
+        ''' Send a frame's worth of (light, state) updates for lights on this bridge '''
+        by_state = {}
+        for light, state in updates:
+            by_state.setdefault(tuple(sorted(state.items())), []).append(light)
+
+        for key, lights in by_state.items():
+            state = dict(key)
+            if len(lights) > 1:
+                lights = self._dispatch_groups(lights, state)
+            for light in lights:
+                light.update(**state)
+
+    def _dispatch_groups(self, lights, state):
+        ''' Cover as many lights as we can with group actions, returning those left over '''
+        remaining = {light.get_id(): light for light in lights}
+        payload = None
+
+        for members, group_id in self.groups.items():
+            if len(remaining) < 2:
+                break
+            if not members.issubset(remaining):
+                continue
+
+            if payload is None:
+                payload = lights[0].payload(**state)
+
+            # Anything still queued for these lights is older than this
+            group_lights = [remaining.pop(light_id) for light_id in members]
+            for light in group_lights:
+                light.queue.discard()
+
+            logger.debug('Setting group %s on %s for %s', group_id, self.id, sorted(members))
+            self.group_actions += 1
+            self._group_queue(group_id).put((payload, state, group_lights))
+
+        return list(remaining.values())
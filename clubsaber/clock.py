@@ -0,0 +1,142 @@
+import array
+import asyncio
+import heapq
+import itertools
+import time
+
+from . import logger
+from . import metrics
+
+
+class SongClock(object):
+    ''' Song time, in seconds, for scheduling a beatmap against the music.
+
+    Time comes from a single monotonic reference rather than summing sleeps,
+    so errors never accumulate. If the audio position can be read, the
+    reference is slewed a little towards it on every sync; it is only jumped
+    when the two are far apart (e.g. the audio stalled), so song time stays
+    smooth while staying locked to the music. '''
+
+    # Fraction of the error against the audio corrected per sync
+    slew = 0.1
+    # Errors larger than this (in seconds) are corrected in one go
+    max_error = 0.25
+    # Longest we sleep without checking in with the audio position
+    sync_interval = 0.1
+
+    def __init__(self, position=None, clock=time.monotonic):
+        self.position = position
+        self.clock = clock
+        self.origin = None
+
+        self.error = 0.0
+        self.jumps = 0
+        self.lateness = array.array('d')
+
+    def start(self, at=0.0):
+        ''' Start counting song time from at seconds into the song '''
+        self.origin = self.clock() - at
+        self.error = 0.0
+        self.lateness = array.array('d')
+
+    def now(self):
+        return self.clock() - self.origin
+
+    def sync(self):
+        ''' Pull song time towards the audio position, if we know it '''
+        if self.position is None:
+            return
+        position = self.position()
+        if position is None or position < 0:
+            return
+
+        # Positive when we're ahead of the music
+        self.error = self.now() - position
+        if abs(self.error) > self.max_error:
+            logger.debug('Song clock off by %.3fs; jumping to the audio', self.error)
+            self.origin += self.error
+            self.jumps += 1
+        else:
+            self.origin += self.error * self.slew
+
+    async def play(self, events, dispatch):
+        ''' Call dispatch(type, value) for each (seconds, type, value) event as its time comes due.
+
+        Every event due by the time we wake is dispatched together, and how late
+        each one went out is recorded. '''
+        if self.origin is None:
+            self.start()
+
+        idx = 0
+        while idx < len(events):
+            self.sync()
+            now = self.now()
+
+            due = events[idx][0]
+            if due > now:
+                await asyncio.sleep(min(due - now, self.sync_interval))
+                continue
+
+            while idx < len(events) and events[idx][0] <= now:
+                at, etype, value = events[idx]
+                dispatch(etype, value)
+                self.lateness.append(now - at)
+                if metrics.enabled:
+                    metrics.observe('lateness', now - at)
+                idx += 1
+
+    async def play_ahead(self, events, route, dispatch, lead):
+        ''' Like play(), but each light gets its part of an event early enough to show it on time.
+
+        route(type, value, at) gives the lights an event goes to, dispatch(light, value) sends
+        it to one of them, and lead(light) is how far ahead of the beat that light
+        needs it. Leads are re-read as each send comes due, so they can keep
+        changing as latency estimates improve. Lateness is how far from the beat
+        each change is expected to land. '''
+        if self.origin is None:
+            self.start()
+
+        # The sequence number keeps each light's events in order, and lights out of comparisons
+        sequence = itertools.count()
+        pending = []
+        for at, etype, value in events:
+            for light in route(etype, value, at):
+                pending.append((at - lead(light), at, next(sequence), light, value))
+        heapq.heapify(pending)
+
+        while pending:
+            self.sync()
+            now = self.now()
+
+            due = pending[0][0]
+            if due > now:
+                await asyncio.sleep(min(due - now, self.sync_interval))
+                continue
+
+            while pending and pending[0][0] <= now:
+                _, at, seq, light, value = heapq.heappop(pending)
+
+                # Our estimate may have grown shorter since this was queued
+                due = at - lead(light)
+                if due > now:
+                    heapq.heappush(pending, (due, at, seq, light, value))
+                    continue
+
+                dispatch(light, value)
+                self.lateness.append(now + lead(light) - at)
+                if metrics.enabled:
+                    metrics.observe('lateness', max(0.0, now + lead(light) - at))
+
+    def stats(self):
+        lateness = sorted(self.lateness)
+        if not lateness:
+            return {'events': 0}
+        return {
+            'events': len(lateness),
+            'mean_lateness': sum(lateness) / len(lateness),
+            'p50_lateness': lateness[len(lateness) // 2],
+            'p99_lateness': lateness[min(len(lateness) - 1, int(0.99 * len(lateness)))],
+            'max_lateness': lateness[-1],
+            'error': self.error,
+            'jumps': self.jumps,
+        }
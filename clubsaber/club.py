@@ -1,19 +1,25 @@
-from .beatsaber import Network, EventType, LightValue
+from .balance import Balancer
+from .beatsaber import Network
 from .config import Config
+from .inventory import Inventory
+from .envelope import OFF, LOW, MED, HI, V_HI
+from . import envelope
 from . import logger
 from .light import Light
+from . import metrics
+from .render import Renderer
+from .shard import ShardPool
+from .supervisor import Supervisor
+from . import protocol
+from . import ratelimit
 import asyncio
+import concurrent.futures
 import json
+import multiprocessing
 import random
-import sys
 import websockets
 
 
-OFF = 0
-LOW = 0.25
-MED = 0.5
-HI = 0.75
-V_HI = 1.0
 WHITE = (255, 255, 255)
 RED = (255, 0, 0)
 GREEN = (0, 255, 0)
@@ -22,8 +28,8 @@ YELLOW = (255, 255, 0)
 
 
 class Club(object):
-    def __init__(self):
-        self.config = Config()
+    def __init__(self, config=None):
+        self.config = config if config is not None else Config()
         self.game_uri = self.config.get('uri')
         self.netmask = self.config.get('netmask')
         self.packet_size = Network.MAX_PACKET_SIZE
@@ -33,9 +39,25 @@ class Club(object):
         self.blue = BLUE
 
         self.celebrating = False
+        self.status_lock = asyncio.Lock()
+        self.supervisor = Supervisor(limit=self.config.get('max_handlers'))
 
         self.game = None
         self.lights = []
+        self.bridges = {}
+        self.missing = {}
+        self.inventory = Inventory(self.config)
+        self.discovery = None
+        self.renderer = Renderer(rate=self.config.get('frame_rate'),
+                                 refresh_interval=self.config.get('refresh_interval'))
+        self.balancer = Balancer.from_config(self.config)
+
+        self.shards = None
+        if self.config.get('light_shards'):
+            self.shards = ShardPool(self.config.get('light_shards'), self.config, self.bridges)
+        self.metrics = None
+        self.recorder = None
+        self.decoder = None
 
     async def _init_game(self):
         print('Attempting to connect to Beat Saber (%s)...' % self.game_uri)
@@ -43,13 +65,126 @@ class Club(object):
                 self.game_uri, max_size=self.packet_size)
 
     async def _init_lights(self):
-        self.lights = await Light.discover(self.config)
-        if not self.lights:
-            raise RuntimeError('Unable to find any lights. Have you done your setup?')
-        print('Discovered %d lights: %s' %
-              (len(self.lights), [light.get_id() for light in self.lights]))
+        # Start straight away with the lights we knew about last time, if any
+        lights = self.inventory.load(self.bridges)
+        from_inventory = bool(lights)
+        if from_inventory:
+            print('Using %d known lights: %s' %
+                  (len(lights), [light.get_id() for light in lights]))
+        else:
+            lights = await Light.discover(self.config, self.bridges)
+            if not lights:
+                raise RuntimeError('Unable to find any lights. Have you done your setup?')
+            print('Discovered %d lights: %s' %
+                  (len(lights), [light.get_id() for light in lights]))
+            self.inventory.save(lights)
+
+        self.build_palettes()
+        self.set_lights(lights)
+        self.renderer.start()
+
+        self.discovery = asyncio.create_task(self.keep_lights_fresh(refresh_now = from_inventory))
+
+    def set_lights(self, lights):
+        if self.shards is not None:
+            # The real lights live in the workers; we drive proxies for them
+            lights = self.shards.assign(lights)
+        self.lights = lights
+        self.renderer.set_lights(lights)
+
+    async def calibrate(self):
+        ''' Find how many commands per second each light really keeps up with, and save it '''
+        lights = self.inventory.load(self.bridges) or await Light.discover(self.config, self.bridges)
+        found = await ratelimit.calibrate_lights(lights)
+
+        rates = dict(self.config.get('light_rates', {}))
+        for light in lights:
+            rate = found.get(light.get_id())
+            if rate is None:
+                print('%s could not keep up with any rate; leaving it unlimited' % light.get_id())
+                continue
+
+            print('%s: %.1f commands/s' % (light.get_id(), rate))
+            rates[light.get_id()] = rate
+            light.set_rate(rate)
+
+        self.config.set('light_rates', rates)
+        for bridge in self.bridges.values():
+            await bridge.close()
+        return rates
+
+    async def keep_lights_fresh(self, refresh_now):
+        interval = self.config.get('rediscover_interval')
+        if not refresh_now:
+            if not interval:
+                return
+            await asyncio.sleep(interval)
+
+        while True:
+            try:
+                await self.rediscover()
+            except Exception as e:
+                logger.warning('Failed to rediscover lights: %s', e)
+
+            if not interval:
+                return
+            await asyncio.sleep(interval)
+
+    async def rediscover(self):
+        ''' Look for lights again, hot-adding new ones and dropping any that have gone away '''
+        # The show is running, so there's nobody at the terminal to pair new bridges
+        found = await Light.discover(self.config, self.bridges, interactive = False)
+        if not found:
+            logger.warning('Rediscovery found no lights; keeping the ones we have')
+            return
+
+        known = {light.get_id(): light for light in self.lights}
+        found_ids = {light.get_id() for light in found}
+
+        lights = []
+        for light in found:
+            # Keep the light we already have (and its state) unless it has moved
+            existing = known.get(light.get_id())
+            if existing is not None and existing.describe() == light.describe():
+                light = existing
+            self.missing.pop(light.get_id(), None)
+            lights.append(light)
+
+        # A bulb can miss a single broadcast; only give up on it after two
+        for id, light in known.items():
+            if id in found_ids:
+                continue
+            self.missing[id] = self.missing.get(id, 0) + 1
+            if self.missing[id] < 2:
+                lights.append(light)
+            else:
+                del self.missing[id]
+
+        kept = {light.get_id() for light in lights}
+        added = [id for id in kept if id not in known]
+        removed = [id for id in known if id not in kept]
+        if added or removed:
+            print('Lights changed: +%s -%s' % (added, removed))
+
+        if len(lights) != len(self.lights) or any(a is not b for a, b in zip(lights, self.lights)):
+            self.set_lights(lights)
+
+        self.inventory.save(found)
+
+    def _init_metrics(self):
+        if not self.config.get('metrics'):
+            return
+
+        metrics.register('renderer', self.renderer.stats)
+        metrics.register('handlers', self.supervisor.stats)
+        if self.balancer is not None:
+            metrics.register('balancer', self.balancer.stats)
+        self.metrics = asyncio.create_task(metrics.run(
+            port = self.config.get('metrics_port'),
+            interval = self.config.get('metrics_interval')))
 
     async def init(self):
+        self._init_metrics()
         await asyncio.gather(
             self._init_game(),
             self._init_lights())
@@ -60,31 +195,19 @@ class Club(object):
 
     async def go_dim(self):
         print('dim')
-        await asyncio.gather(*[
-            light.update(rgb = self.red, brightness = LOW, speed = 0.2)
-            for light in self.lights])
+        self.renderer.set_all(rgb = self.red, brightness = LOW, speed = 0.2)
 
     async def go_ambient(self):
         print('ambient')
-        await asyncio.gather(*[
-            light.update(rgb = YELLOW, brightness = HI, speed = 0.4)
-            for light in self.lights])
+        self.renderer.set_all(rgb = YELLOW, brightness = HI, speed = 0.4)
 
     async def run(self):
-        tasks = []
-
         while True:
             try:
-                # TODO: Report on exceptions
-                tasks = [t for t in tasks if not t.done()]
-
                 packet = await self.game.recv()
-                data = json.loads(packet)
-
-                handler = self.handlers.get(data.get('event'))
-                if handler:
-                    tasks.append(asyncio.create_task(
-                        handler(self, data)))
+                if self.recorder is not None:
+                    self.recorder.record(packet)
+                self.receive(packet)
 
             # Packet overruns will cause the connection to be closed; try again
             except websockets.exceptions.ConnectionClosed as e:
@@ -99,6 +222,53 @@ class Club(object):
                 self.game = await websockets.connect(
                         self.game_uri, max_size=self.packet_size)
 
+    def receive(self, packet):
+        ''' Handle one frame from the game, whether live or replayed '''
+        received = metrics.now() if metrics.enabled else None
+
+        # Map events are by far the most frequent; handle them inline
+        event = protocol.sniff(packet)
+        if event == 'beatmapEvent':
+            fields = protocol.decode_map_event(packet)
+            if fields:
+                if received is not None:
+                    decoded = metrics.now()
+                    metrics.observe('decode', decoded - received)
+                self.dispatch_map_event(*fields)
+                if received is not None:
+                    metrics.observe('dispatch', metrics.now() - decoded)
+                return
+
+        if received is not None:
+            metrics.count(event or 'unknown')
+        self.supervisor.spawn(self.receive_status(packet, received),
+            sheddable = event in self.sheddable_events)
+
+    async def receive_status(self, packet, received=None):
+        # Frames are decoded one at a time so handlers still run in the order they arrived
+        async with self.status_lock:
+            if received is not None:
+                decoding = metrics.now()
+            if len(packet) > protocol.OFFLOAD_SIZE:
+                # Parsing holds the GIL throughout, so huge frames are decoded in another process
+                if self.decoder is None:
+                    self.decoder = concurrent.futures.ProcessPoolExecutor(
+                        max_workers = 1, mp_context = multiprocessing.get_context('spawn'))
+                event, data = await asyncio.get_running_loop().run_in_executor(
+                    self.decoder, protocol.decode_status, packet)
+            else:
+                event, data = protocol.decode_status(packet)
+        del packet
+
+        if received is not None:
+            decoded = metrics.now()
+            metrics.observe('decode', decoded - decoding)
+            metrics.observe('handler', decoded - received)
+
+        handler = self.handlers.get(event)
+        if handler:
+            await handler(self, data)
+
     def report_status(self, data):
         status = data.get('status') or {}
         bm = status.get('beatmap')
@@ -119,8 +289,8 @@ class Club(object):
         if colors:
             print('Colors: %s' % json.dumps(colors, indent='\t'))
 
-            self.red = colors['environment0'] if 'environment0' in colors else RED
-            self.blue = colors['environment1'] if 'environment1' in colors else BLUE
+            self.red = tuple(colors['environment0']) if 'environment0' in colors else RED
+            self.blue = tuple(colors['environment1']) if 'environment1' in colors else BLUE
 
             # TODO: Boost / sabers?
 
@@ -131,6 +301,24 @@ class Club(object):
 
         self.bpm = status.get('songBPM', 60/0.666)
 
+        self.build_palettes()
+
+    def build_palettes(self):
+        ''' Precompute light payloads for every state the show can produce with these colors '''
+        states = [
+            (self.red, LOW, 0.2),   # dim
+            (YELLOW, HI, 0.4),      # ambient
+            (YELLOW, HI, 0.9),      # hello
+        ]
+        for effect in envelope.effects():
+            for _, brightness, speed in effect.keyframes:
+                if brightness != OFF:
+                    states += [(self.red, brightness, speed), (self.blue, brightness, speed)]
+
+        Light.build_palettes(states)
+        if self.shards is not None:
+            self.shards.build_palettes(states)
+
     async def receive_hello(self, data):
         print('Hello Beat Saber!')
         self.report_status(data)
@@ -139,10 +327,11 @@ class Club(object):
         dt = 60 / 180
         for loop in range(4):
             for off_light_idx in range(len(self.lights)):
-                await asyncio.gather(*[
-                   light.update(on = False) if idx == off_light_idx else
-                    light.update(rgb = YELLOW, brightness = HI, speed = 0.9)
-                   for idx, light in enumerate(self.lights)])
+                for idx in range(len(self.lights)):
+                    if idx == off_light_idx:
+                        self.renderer.set(idx, on = False)
+                    else:
+                        self.renderer.set(idx, rgb = YELLOW, brightness = HI, speed = 0.9)
                 await asyncio.sleep(dt)
 
         await self.go_ambient()
@@ -152,12 +341,23 @@ class Club(object):
         self.process_environment(data)
         await self.enter_game()
 
+    def report_lights(self):
+        for light in self.lights:
+            logger.info('%s: %s', light.get_id(), light.stats())
+        for batcher in {light.batcher() for light in self.lights} - {None}:
+            logger.info('%s: %s', batcher.id, batcher.stats())
+        logger.info('Renderer: %s', self.renderer.stats())
+        logger.info('Handlers: %s', self.supervisor.stats())
+
     async def receive_end(self, data):
+        self.report_lights()
+
         status = data.get('status') or {}
         perf = status.get('performance') or {}
 
         if perf and not perf.get('softFailed', False):
-            asyncio.create_task(self.celebrate(perf))
+            self.supervisor.spawn(self.celebrate(perf),
+                sheddable = True, key = 'celebrate')
         else:
             self.celebrating = False
 
@@ -185,27 +385,23 @@ class Club(object):
         print('Yay! We got an %s (%d)!' % (
             performance.get('rank'), performance.get('score', -1)))
 
-        tasks = []
-
         score_light_idx = 0
 
         while self.celebrating:
-            for idx, light in enumerate(self.lights):
+            for idx in range(len(self.lights)):
                 if idx == score_light_idx:
-                    tasks.append(light.update(rgb = rank, brightness = V_HI, speed = 0.4))
+                    self.renderer.set(idx, rgb = rank, brightness = V_HI, speed = 0.4)
                     continue
 
                 color = random.choice([self.red, self.blue])
-                tasks.append(light.update(
+                self.renderer.set(idx,
                     rgb = color,
                     brightness = random.random() * (V_HI - MED) + MED,
                     speed = random.randrange(40, 90) / 100.0
-                ))
+                )
 
-            tasks.append(asyncio.sleep(dt))
-            await asyncio.gather(*tasks)
+            await asyncio.sleep(dt)
 
-            tasks.clear()
             score_light_idx = (score_light_idx + 1) % len(self.lights)
 
     async def receive_pause(self, data):
@@ -224,41 +420,38 @@ class Club(object):
 
     async def receive_map_event(self, data):
         event = data.get('beatmapEvent', {})
-        etype = event.get('type')
-        value = event.get('value')
-
-        lights = self.config.get_lights_for_event(self.lights, etype)
-        if not lights:
+        self.dispatch_map_event(event.get('type'), event.get('value'))
+
+    def dispatch_map_event(self, etype, value):
+        if metrics.enabled:
+            routing = metrics.now()
+            indices = self.config.get_light_indices_for_event(self.lights, etype)
+            metrics.observe('route', metrics.now() - routing)
+            metrics.count('beatmapEvent')
+        else:
+            indices = self.config.get_light_indices_for_event(self.lights, etype)
+        if self.balancer is not None:
+            indices = self.balancer.choose(etype, value, indices, self.lights, now = self.renderer.clock())
+        if not indices:
             return
 
-        sys.stdout.write('%s %s\r' % (etype, value))
-        await asyncio.gather(*[
-            self.handle_light_event(light, value) for light in lights
-        ])
-
-    async def handle_light_event(self, light, value):
-        if value == LightValue.OFF:
-            await light.update(on = False)
-        elif value == LightValue.RED_ON:
-            await light.update(rgb = self.red, brightness = MED, speed = 0.8)
-        elif value == LightValue.BLUE_ON:
-            await light.update(rgb = self.blue, brightness = MED, speed = 0.8)
-        elif value == LightValue.RED_FADE:
-            await light.update(rgb = self.red, brightness = HI,  speed = 0.8)
-            await asyncio.sleep(0.2)
-            await light.update(rgb = self.red, brightness = LOW, speed = 0.2)
-        elif value == LightValue.BLUE_FADE:
-            await light.update(rgb = self.blue, brightness = HI,  speed = 0.8)
-            await asyncio.sleep(0.2)
-            await light.update(rgb = self.blue, brightness = LOW, speed = 0.2)
-        elif value == LightValue.RED_FLASH:
-            await light.update(rgb = self.red, brightness = HI,  speed = 0.8)
-            await asyncio.sleep(0.1)
-            await light.update(rgb = self.red, brightness = MED, speed = 0.4)
-        elif value == LightValue.BLUE_FLASH:
-            await light.update(rgb = self.blue, brightness = HI,  speed = 0.8)
-            await asyncio.sleep(0.1)
-            await light.update(rgb = self.blue, brightness = MED, speed = 0.4)
+        logger.debug('Map event %s %s', etype, value)
+        for idx in indices:
+            self.render_light_event(idx, value)
+
+    def render_light_event(self, idx, value):
+        effect = envelope.for_light_value(value, self.red, self.blue)
+        if effect:
+            self.renderer.play(idx, effect)
+
+    def render_event_for_light(self, light, value):
+        ''' Like render_light_event, but by light; ignored if the light has since gone away '''
+        idx = self.renderer.index.get(light)
+        if idx is not None:
+            self.render_light_event(idx, value)
+
+    # Handlers which only put on a show, and may be dropped if we're overloaded
+    sheddable_events = {'hello', 'beatmapEvent'}
 
     handlers = {
         'hello': receive_hello,
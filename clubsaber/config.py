@@ -1,23 +1,40 @@
 import json
 import os
+import time
 
 import appdirs
 
+from . import logger
 from .beatsaber import EventType
 
 
 class Config(object):
+    # How often (in seconds) to check the config file for changes on disk
+    reload_interval = 1.0
+
     def __init__(self, **values):
         self.config = dict()
+        self.overrides = values
+        self.path = os.path.join(appdirs.user_config_dir(), 'club-saber.json')
+
+        self._mtime = None
+        self._checked = time.monotonic()
+        self._load()
 
-        config_dir = appdirs.user_config_dir()
+        self.invalidate_routes()
+
+    def _load(self):
+        config = dict()
         try:
-            with open(os.path.join(config_dir, 'club-saber.json')) as config_file:
-                self.config = json.load(config_file)
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path) as config_file:
+                config = json.load(config_file)
         except FileNotFoundError:
-            pass
+            mtime = None
 
-        self.config.update(**values)
+        self.config = config
+        self._mtime = mtime
+        self.config.update(**self.overrides)
 
         self._set_defaults()
 
@@ -26,10 +43,32 @@ class Config(object):
         host = self.config.setdefault('host', 'localhost')
         port = self.config.setdefault('port', 6557)
         self.config.setdefault('uri', 'ws://%s:%d/socket' % (host, port))
+        self.config.setdefault('max_handlers', 16)
+        self.config.setdefault('metrics', False)
+        self.config.setdefault('metrics_port', 0)
+        self.config.setdefault('metrics_interval', 30.0)
 
         # Light Settings
         self.config.setdefault('bridges', {})
         self.config.setdefault('netmask', '192.168.1.255')
+        self.config.setdefault('rediscover_interval', 0)
+        self.config.setdefault('frame_rate', 30)
+        self.config.setdefault('light_shards', 0)
+        self.config.setdefault('suppress_threshold', 0.02)
+        self.config.setdefault('refresh_interval', 10.0)
+        self.config.setdefault('wiz_fire_and_forget', False)
+        self.config.setdefault('wiz_reconcile_interval', 5.0)
+        self.config.setdefault('hue_timeout', 1.0)
+        self.config.setdefault('hue_max_inflight', 3)
+        self.config.setdefault('hue_breaker_threshold', 3)
+        self.config.setdefault('hue_breaker_cooldown', 5.0)
+        self.config.setdefault('lookahead', True)
+        self.config.setdefault('compile_schedule', True)
+        self.config.setdefault('light_rates', {})
+        self.config.setdefault('light_burst', 2)
+        self.config.setdefault('balance', None)
+        self.config.setdefault('balance_width', 1)
+        self.config.setdefault('max_lookahead', 0.5)
 
     def get(self, key, default=None):
         return self.config.get(key, default)
@@ -37,11 +76,35 @@ class Config(object):
     def set(self, key, value):
         self.config[key] = value
 
-        config_dir = appdirs.user_config_dir()
-        with open(os.path.join(config_dir, 'club-saber.json'), 'w') as config_file:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as config_file:
             json.dump(self.config, config_file)
+        self._mtime = os.stat(self.path).st_mtime
+
+        self.invalidate_routes()
 
-    _light_events = [
+    def _check_for_changes(self):
+        now = time.monotonic()
+        if now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime != self._mtime:
+            try:
+                self._load()
+            except (ValueError, OSError) as e:
+                # Likely caught mid-save; keep what we had until the file changes again
+                logger.warning('Keeping the previous config; failed to reload %s: %s', self.path, e)
+                self._mtime = mtime
+                return
+            self.invalidate_routes()
+
+    _light_events = frozenset([
         EventType.BACK_LASERS,
         EventType.RING_LIGHTS,
         EventType.LEFT_LASERS,
@@ -54,17 +117,53 @@ class Config(object):
         EventType.CUSTOM_LIGHT_5,
         EventType.CUSTOM_EVENT_1,
         EventType.CUSTOM_EVENT_2,
-    ]
-
-    def get_lights_for_event(self, lights: list, event):
-        if event not in self._light_events:
-            return []
-
-        ignored = self.get('lights_ignored', [])
-        lights = filter(lambda l: l.get_id() not in ignored, lights)
-
+    ])
+
+    def invalidate_routes(self):
+        ''' Force the event routing table to be rebuilt on next use '''
+        self._routed_lights = None
+        self._routed_count = 0
+        self._routes = {}
+        self._route_indices = {}
+
+    def compile_routes(self, lights):
+        ''' Precompute which lights each light event is routed to '''
+        ignored = set(self.get('lights_ignored', []))
         mapping = self.get('light_event_map', {})
-        lights = filter(lambda l: l.get_id() not in mapping or event in mapping[l.get_id()], lights)
 
-        return lights
+        masks = {}
+        for idx, light in enumerate(lights):
+            id = light.get_id()
+            if id in ignored:
+                continue
+
+            events = self._light_events
+            if id in mapping:
+                events = events.intersection(mapping[id])
+
+            for event in events:
+                masks[event] = masks.get(event, 0) | (1 << idx)
+
+        self._route_indices = {
+            event: tuple(idx for idx in range(len(lights)) if mask >> idx & 1)
+            for event, mask in masks.items()
+        }
+        self._routes = {
+            event: tuple(lights[idx] for idx in indices)
+            for event, indices in self._route_indices.items()
+        }
+        self._routed_lights = lights
+        self._routed_count = len(lights)
+
+    def _ensure_routes(self, lights):
+        self._check_for_changes()
+        if lights is not self._routed_lights or len(lights) != self._routed_count:
+            self.compile_routes(lights)
+
+    def get_lights_for_event(self, lights: list, event):
+        self._ensure_routes(lights)
+        return self._routes.get(event, ())
 
+    def get_light_indices_for_event(self, lights: list, event):
+        self._ensure_routes(lights)
+        return self._route_indices.get(event, ())
@@ -0,0 +1,105 @@
+from .beatsaber import LightValue
+
+
+OFF = 0
+LOW = 0.25
+MED = 0.5
+HI = 0.75
+V_HI = 1.0
+
+
+class Envelope(object):
+    ''' A timed sequence of (delay, brightness, speed) keyframes for one light.
+
+    An envelope only ever moves forward; once a newer envelope lands on the
+    same light it is cancelled and its remaining keyframes are never sent. '''
+
+    keyframes = ()
+
+    def __init__(self, rgb=None):
+        self.rgb = rgb
+        self.start = 0.0
+        self.position = 0
+
+    def begin(self, now):
+        self.start = now
+        self.position = 0
+
+    def done(self):
+        return self.position >= len(self.keyframes)
+
+    def deadline(self):
+        if self.done():
+            return None
+        return self.start + self.keyframes[self.position][0]
+
+    def advance(self, now):
+        ''' Consume every keyframe due by now, returning the newest state (or None) '''
+        keyframe = None
+        while not self.done() and self.start + self.keyframes[self.position][0] <= now:
+            keyframe = self.keyframes[self.position]
+            self.position += 1
+
+        if keyframe is None:
+            return None
+
+        _, brightness, speed = keyframe
+        if brightness == OFF:
+            return dict(on = False)
+        return dict(rgb = self.rgb, brightness = brightness, speed = speed)
+
+    def cancel(self):
+        ''' Drop any unsent keyframes, returning how many there were '''
+        remaining = len(self.keyframes) - self.position
+        self.position = len(self.keyframes)
+        return remaining
+
+    def __repr__(self):
+        return '<%s %s @%d/%d>' % (type(self).__name__, self.rgb,
+                                   self.position, len(self.keyframes))
+
+
+class Off(Envelope):
+    keyframes = ((0, OFF, None),)
+
+
+class On(Envelope):
+    keyframes = ((0, MED, 0.8),)
+
+
+class Flash(Envelope):
+    keyframes = ((0, HI, 0.8), (0.1, MED, 0.4))
+
+
+class Fade(Envelope):
+    keyframes = ((0, HI, 0.8), (0.2, LOW, 0.2))
+
+
+_effects = {
+    LightValue.OFF:        (Off,   None),
+    LightValue.BLUE_ON:    (On,    'blue'),
+    LightValue.BLUE_FLASH: (Flash, 'blue'),
+    LightValue.BLUE_FADE:  (Fade,  'blue'),
+    LightValue.RED_ON:     (On,    'red'),
+    LightValue.RED_FLASH:  (Flash, 'red'),
+    LightValue.RED_FADE:   (Fade,  'red'),
+}
+
+
+def for_light_value(value, red, blue):
+    ''' Build the envelope for a beatmap light value, or None if it isn't one '''
+    effect = _effects.get(value)
+    if not effect:
+        return None
+
+    envelope, color = effect
+    if color == 'red':
+        return envelope(red)
+    elif color == 'blue':
+        return envelope(blue)
+    return envelope()
+
+
+def effects():
+    ''' Every kind of envelope a light value can produce '''
+    return {envelope for envelope, _ in _effects.values()}
@@ -0,0 +1,62 @@
+import json
+import os
+
+import appdirs
+
+from . import logger
+from .light import Light
+
+
+class Inventory(object):
+    ''' The lights (and Hue bridges) found last time, so startup needn't wait on discovery '''
+
+    def __init__(self, config):
+        self.config = config
+        self.path = os.path.join(appdirs.user_config_dir(), 'club-saber-lights.json')
+
+    def load(self, bridges):
+        ''' Recreate the saved lights, adding their bridges to bridges '''
+        try:
+            with open(self.path) as inventory_file:
+                inventory = json.load(inventory_file)
+        except FileNotFoundError:
+            return []
+        except ValueError as e:
+            logger.warning('Ignoring unreadable light inventory %s: %s', self.path, e)
+            return []
+
+        return [light for light in self.recreate(inventory, self.config, bridges) if light is not None]
+
+    @staticmethod
+    def recreate(inventory, config, bridges):
+        ''' Recreate the described lights (None for any we can't), adding their bridges to bridges '''
+        saved_bridges = inventory.get('bridges', {})
+        if saved_bridges:
+            try:
+                from .bridge import HueBridge
+                for id, description in saved_bridges.items():
+                    bridge = HueBridge.from_description(id, description, config)
+                    if bridge is not None:
+                        bridges[id] = bridge
+            except ImportError:
+                logger.debug('Failed to import hue. Hue lights unsupported')
+
+        return [Light.from_description(description, config, bridges)
+                for description in inventory.get('lights', [])]
+
+    def save(self, lights):
+        bridges = {}
+        for light in lights:
+            bridge = light.batcher()
+            if bridge is not None:
+                bridges[bridge.id] = bridge.describe()
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as inventory_file:
+                json.dump({
+                    'lights': [light.describe() for light in lights],
+                    'bridges': bridges,
+                }, inventory_file)
+        except OSError as e:
+            logger.warning('Failed to save light inventory %s: %s', self.path, e)
@@ -1,35 +1,231 @@
+import array
 import asyncio
 import colorsys
+import functools
 import itertools
+import math
+import time
 
 from . import logger
+from . import metrics
+from .queue import CommandQueue
+from .ratelimit import TokenBucket
+from .wiz import WizTransport
+from . import wiz
+
+try:
+    from pywizlight import PilotBuilder
+except ImportError:
+    PilotBuilder = None
 
 
 class Light(object):
+    # How many translations of states outside the palette to remember
+    adhoc_cache_size = 256
+
+    # How long (in seconds) a light takes to show a state once it has it
+    apply_latency = 0.0
+    # Weight given to each new round-trip sample in the latency estimate
+    latency_smoothing = 0.2
+
+    def __init__(self, config):
+        self.config = config
+        self.queue = CommandQueue(self._transmit, name=self.get_id())
+        self.set_rate(config.get('light_rates', {}).get(self.get_id()))
+
+        self.last_payload = None
+        self.last_state = None
+        self.last_sent = 0.0
+        self.suppressed = 0
+
+        self.rtt = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # Ready-to-send payloads, keyed by (on, rgb, brightness, speed)
+        cls.palette = {}
+        cls._translate_adhoc = staticmethod(
+            functools.lru_cache(maxsize=cls.adhoc_cache_size)(cls.translate))
+
+    @classmethod
+    def build_palette(cls, states):
+        ''' Precompute payloads for the (rgb, brightness, speed) states we expect to send a lot '''
+        palette = {(False, (255, 255, 255), 1.0, 0.5): cls.translate(on=False)}
+        for rgb, brightness, speed in states:
+            rgb = tuple(rgb)
+            palette[(True, rgb, brightness, speed)] = cls.translate(True, rgb, brightness, speed)
+        cls.palette = palette
+
+    @staticmethod
+    def build_palettes(states):
+        for cls in Light.__subclasses__():
+            cls.build_palette(states)
+
+    @classmethod
+    def payload(cls, on=True, rgb=(255, 255, 255), brightness=1.0, speed=0.5):
+        ''' Translate a state into what goes on the wire. Payloads are shared; don't modify them '''
+        payload = cls.palette.get((on, rgb, brightness, speed))
+        if payload is None:
+            payload = cls._translate_adhoc(on, rgb, brightness, speed)
+        return payload
+
+    @staticmethod
+    def translate(on=True, rgb=(255, 255, 255), brightness=1.0, speed=0.5):
+        raise NotImplementedError
+
     @staticmethod
-    async def discover(config):
-        lights = []
+    async def discover(config, bridges=None, interactive=True):
+        ''' Find every light we can drive. Known Hue bridges (by ID) are reused and new ones added.
 
-        async for light in Light._discover_hue(config):
-            lights.append(light)
+        Pairing with a new bridge asks at the terminal, so only happens if interactive. '''
+        if bridges is None:
+            bridges = {}
 
-        async for light in Light._discover_wiz(config):
-            lights.append(light)
+        async def collect(lights):
+            return [light async for light in lights]
 
-        return lights
+        hue_lights, wiz_lights = await asyncio.gather(
+            collect(Light._discover_hue(config, bridges, interactive)),
+            collect(Light._discover_wiz(config)))
 
-    async def update(**state):
+        return hue_lights + wiz_lights
+
+    @staticmethod
+    def from_description(description, config, bridges):
+        ''' Recreate a light from describe() without touching the network; None if we can't '''
+        kind = description.get('kind')
+        if kind == 'hue':
+            bridge = bridges.get(description.get('bridge'))
+            if bridge is None:
+                return None
+            return HueLight(description['id'], bridge, config)
+        elif kind == 'wiz':
+            return WizLight(description['ip'], description['id'], config)
+        return None
+
+    def describe(self):
+        ''' Enough about this light to recreate it on the next run '''
         raise NotImplementedError
 
+    def set_rate(self, rate):
+        ''' Cap how many commands per second go to this light; None for no cap '''
+        self.queue.limiter = TokenBucket(rate, self.config.get('light_burst')) if rate else None
+
+    def update(self, **state):
+        ''' Request a new state; returns an awaitable which completes once it (or a newer state) is sent '''
+        return self.queue.put(state)
+
+    async def _transmit(self, state):
+        if metrics.enabled:
+            translating = metrics.now()
+            payload = self.payload(**state)
+            metrics.observe('translate', metrics.now() - translating)
+        else:
+            payload = self.payload(**state)
+
+        now = time.monotonic()
+        if self.suppress(payload, now):
+            return False
+
+        if metrics.enabled:
+            sending = metrics.now()
+            sent = await self._send(payload)
+            metrics.observe('send', metrics.now() - sending)
+        else:
+            sent = await self._send(payload)
+
+        if sent is False:
+            return False
+        self.sent_payload(payload, now, state)
+
+    def suppress(self, payload, now):
+        ''' Whether to skip sending a payload, counting it if so '''
+        # Skip sends the bulb couldn't visibly show, unless it's been a while and it may have drifted
+        if self.last_payload is not None \
+                and now - self.last_sent < self.config.get('refresh_interval') \
+                and self.difference(self.last_payload, payload) <= self.config.get('suppress_threshold'):
+            self.suppressed += 1
+            return True
+        return False
+
+    def sent_payload(self, payload, now=None, state=None):
+        ''' Record a payload (and the state it came from) as the light's current state, however it got there '''
+        self.last_payload = payload
+        self.last_sent = time.monotonic() if now is None else now
+        if state is not None:
+            self.last_state = state
+
+    def refresh(self, now=None):
+        ''' Send the light its last state again if nothing has gone out for refresh_interval,
+        in case it drifted or missed it. Returns whether it did '''
+        if now is None:
+            now = time.monotonic()
+        if self.last_state is None or self.queue.busy() \
+                or now - self.last_sent < self.config.get('refresh_interval'):
+            return False
+
+        # Suppression would otherwise take the light at its word
+        self.last_payload = None
+        self.update(**self.last_state)
+        return True
+
+    def observe_rtt(self, rtt):
+        ''' Fold a measured round trip into the running estimate '''
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += self.latency_smoothing * (rtt - self.rtt)
+
+    def latency(self):
+        ''' Estimated time from sending a state to it being visible '''
+        return (self.rtt or 0.0) / 2 + self.apply_latency
+
+    @staticmethod
+    def difference(a, b):
+        ''' How perceptibly different two payloads are: 0 for identical, 1+ for wildly different '''
+        return 0.0 if a == b else math.inf
+
+    def stats(self):
+        return dict(self.queue.stats(), suppressed = self.suppressed, latency = self.latency())
+
+    def batcher(self):
+        ''' An object able to send updates for several lights at once, if there is one '''
+        return None
+
+    @staticmethod
+    def dispatch(updates):
+        ''' Send a frame's worth of (light, state) updates, batching them where lights allow '''
+        batches = {}
+        for light, state in updates:
+            batcher = light.batcher()
+            if batcher is None:
+                light.update(**state)
+            else:
+                batches.setdefault(batcher, []).append((light, state))
+
+        for batcher, batch in batches.items():
+            batcher.dispatch(batch)
+
+    async def _send(self, payload):
+        raise NotImplementedError
+
+    async def probe(self, payload):
+        ''' Send a payload straight to the light and wait until it confirms, for calibration '''
+        if await self._send(payload) is False:
+            raise RuntimeError('%s shed the request' % self.get_id())
+
     def get_id(self):
         raise NotImplementedError
 
     @staticmethod
-    async def _discover_hue(config):
+    async def _discover_hue(config, bridges, interactive=True):
         try:
             import hue
+            from .bridge import HueBridge
+
             bridge_configs = config.get('bridges', {})
-            if not bridge_configs:
+            if not bridge_configs and interactive:
                 for info in await hue.Bridge.discover():
                     logger.info(info)
                     if not info.get('id') or not info.get('internalipaddress'):
@@ -45,10 +241,14 @@ class Light(object):
             for id, bridge_config in bridge_configs.items():
                 user = bridge_config['username']
                 ip = bridge_config['ip']
-                bridge = hue.Bridge(ip=ip, user=user)
-                bridge_info = await bridge.get_info()
+                bridge_info = await hue.Bridge(ip=ip, user=user).get_info()
                 logger.debug('Bridge Info: %s' % bridge_info)
 
+                bridge = bridges.get(id)
+                if bridge is None or bridge.ip != ip:
+                    bridge = bridges[id] = HueBridge(id, ip, user, config)
+                bridge.set_groups(bridge_info)
+
                 lights = bridge_info['lights']
                 light_keys = lights.keys()
                 if 'group' in bridge_config:
@@ -60,7 +260,7 @@ class Light(object):
                     if light_id not in light_keys:
                         continue
 
-                    yield HueLight(hue.Light(id=light_id, ip=ip, user=user), config)
+                    yield HueLight(light_id, bridge, config)
 
         except ImportError:
             logger.debug('Failed to import hue. Hue lights unsupported')
@@ -101,25 +301,52 @@ class Light(object):
             wizlights = await pywizlight.discovery.discover_lights(
                     broadcast_space=config.get('netmask'))
             for light in wizlights:
-                yield WizLight(light, config)
+                yield WizLight(light.ip, light.mac, config)
         except ImportError:
             logger.debug('Failed to import pywizlight. WiZ lights unsupported')
 
 
 class HueLight(Light):
-    def __init__(self, huelight, config):
-        self.light = huelight
-        self.config = config
+    # The bridge answers before the change has gone out over Zigbee
+    apply_latency = 0.04
+
+    def __init__(self, id, bridge, config):
+        self.id = id
+        self.bridge = bridge
+        super().__init__(config)
 
     def get_id(self):
-        return self.light.id
+        return self.id
 
-    async def update(self, **state):
-        try:
-            await self.light.set_state(self.translate(**state))
-        except Exception as e:
-            print(e)
-            pass # FIXME: Seems like we timeout a lot... :thinking:
+    def describe(self):
+        return {'kind': 'hue', 'id': self.id, 'bridge': self.bridge.id}
+
+    def batcher(self):
+        return self.bridge
+
+    def set_rate(self, rate):
+        super().set_rate(rate)
+        self.bridge.set_rate(self.id, rate)
+
+    async def _send(self, payload):
+        start = time.monotonic()
+        if await self.bridge.set_light_state(self.id, payload) is False:
+            return False
+        self.observe_rtt(time.monotonic() - start)
+
+    @staticmethod
+    def difference(a, b):
+        if a['on'] != b['on']:
+            return math.inf
+        if not a['on']:
+            return 0.0
+
+        # Hue is circular, and matters less the less saturated the color is
+        dhue = abs(a['hue'] - b['hue'])
+        dhue = min(dhue, 65536 - dhue) / 32768 * max(a['sat'], b['sat']) / 254
+        return max(dhue,
+                   abs(a['bri'] - b['bri']) / 254,
+                   abs(a['sat'] - b['sat']) / 254)
 
     @staticmethod
     def translate(on=True, rgb=(255, 255, 255), brightness=1.0, speed=0.5):
@@ -136,22 +363,66 @@ class HueLight(Light):
 
 
 class WizLight(Light):
-    def __init__(self, wizlight, config):
-        self.light = wizlight
-        self.config = config
+    def __init__(self, ip, mac, config):
+        self.ip = ip
+        self.mac = mac
+        self.intended = None
+        self.transport = None
+        super().__init__(config)
 
     def get_id(self):
-        return self.light.mac
+        return self.mac
+
+    def describe(self):
+        return {'kind': 'wiz', 'id': self.mac, 'ip': self.ip}
+
+    async def _send(self, params):
+        transport = self.transport = await WizTransport.shared(
+                self.config.get('wiz_port', wiz.PORT))
+        message = {'method': 'setPilot', 'params': params}
+
+        if self.config.get('wiz_fire_and_forget'):
+            # Don't wait on the bulb; the transport tracks acks and reconciles drift
+            self.intended = params
+            transport.register(self, self.config.get('wiz_reconcile_interval'))
+            transport.post(self.ip, message, on_ack=self.observe_rtt)
+            return
+
+        start = time.monotonic()
+        response = await transport.request(self.ip, message)
+        self.observe_rtt(time.monotonic() - start)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+
+    async def probe(self, params):
+        # Always wait for the reply, and don't resend: a lost command should count as lost
+        transport = await WizTransport.shared(self.config.get('wiz_port', wiz.PORT))
+        response = await transport.request(self.ip, {'method': 'setPilot', 'params': params},
+                                           attempts = 1)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
 
-    async def update(self, on=True, **state):
-        if on:
-            await self.light.turn_on(self.translate(**state))
-        else:
-            await self.light.turn_off()
+    @staticmethod
+    def difference(a, b):
+        if a['state'] != b['state']:
+            return math.inf
+        if not a['state']:
+            return 0.0
+
+        return max(max(abs(a.get(k, 0) - b.get(k, 0)) for k in ('r', 'g', 'b')) / 255,
+                   abs(a.get('dimming', 0) - b.get('dimming', 0)) / 100)
+
+    def stats(self):
+        stats = super().stats()
+        if self.transport and self.ip in self.transport.acks:
+            stats.update(self.transport.acks[self.ip])
+            stats['loss'] = self.transport.loss_rate(self.ip)
+        return stats
 
     @staticmethod
     def translate(on=True, rgb=(255, 255, 255), brightness=1.0, speed=0.5):
-        from pywizlight import PilotBuilder
+        if not on:
+            return {'state': False}
 
         h, s, v = colorsys.rgb_to_hsv(*rgb)
         pilot = PilotBuilder(
@@ -166,9 +437,68 @@ class WizLight(Light):
 
         logger.debug('Pilot: %s', pilot.__dict__)
 
-        return pilot
+        return dict(pilot.pilot_params, state = True)
 
     @staticmethod
     def _round_color(value):
         return min(255, round(value / 128) * 128)
 
+
+
+class VirtualLight(Light):
+    ''' A light which only records when it would have been sent something, for headless simulation.
+
+    Updates are handled on the spot rather than queued, against whatever clock
+    the simulation runs on, with the same suppression a real light applies. '''
+
+    def __init__(self, id, config, clock=time.monotonic):
+        self.id = id
+        self.clock = clock
+        self.commands = array.array('d')
+        super().__init__(config)
+
+    def get_id(self):
+        return self.id
+
+    def describe(self):
+        return {'kind': 'virtual', 'id': self.id}
+
+    def update(self, **state):
+        payload = self.payload(**state)
+        now = self.clock()
+        if self.suppress(payload, now):
+            return
+        self.commands.append(now)
+        self.sent_payload(payload, now, state)
+
+    def peak_rate(self, window=1.0):
+        ''' The most commands sent within any window seconds, per second '''
+        peak = 0
+        first = 0
+        for last, now in enumerate(self.commands):
+            while now - self.commands[first] >= window:
+                first += 1
+            peak = max(peak, last - first + 1)
+        return peak / window
+
+    def stats(self):
+        return {
+            'commands': len(self.commands),
+            'suppressed': self.suppressed,
+            'peak_rate': self.peak_rate(),
+        }
+
+    @staticmethod
+    def difference(a, b):
+        if a['on'] != b['on']:
+            return math.inf
+        if not a['on']:
+            return 0.0
+        return max(max(abs(x - y) for x, y in zip(a['rgb'], b['rgb'])) / 255,
+                   abs(a['brightness'] - b['brightness']))
+
+    @staticmethod
+    def translate(on=True, rgb=(255, 255, 255), brightness=1.0, speed=0.5):
+        if not on:
+            return {'on': False}
+        return {'on': True, 'rgb': tuple(rgb), 'brightness': brightness, 'speed': speed}
@@ -1,17 +1,49 @@
 from clubsaber.club import Club
+from clubsaber.recording import Recorder, Recording, replay
+import argparse
 import asyncio
 
 
-async def async_main():
+async def async_main(args):
     club = Club()
-    await club.init()
-    await club.run()
+
+    if args.calibrate:
+        await club.calibrate()
+        return
+
+    if args.replay:
+        await club._init_lights()
+        with Recording(args.replay) as recording:
+            await replay(club, recording, speed = args.speed)
+        # Give the last effects a moment to reach the lights
+        await asyncio.sleep(1)
+        club.report_lights()
+        return
+
+    if args.record:
+        club.recorder = Recorder(args.record)
+    try:
+        await club.init()
+        await club.run()
+    finally:
+        if club.recorder:
+            club.recorder.close()
 
 
 def main():
-    asyncio.run(async_main())
+    parser = argparse.ArgumentParser(description='Control smart lights based on Beat Saber map data')
+    parser.add_argument('--record', metavar='FILE',
+                        help='Record everything the game sends to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='Play a recording to the lights instead of connecting to the game')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay at this many times real time (0 for as fast as possible)')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Measure how fast each light can take commands, save it and exit')
+    args = parser.parse_args()
+
+    asyncio.run(async_main(args))
 
 
 if __name__ == '__main__':
     main()
-
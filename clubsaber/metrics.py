@@ -0,0 +1,183 @@
+''' Pipeline timing, for finding out where the lag comes from during a show.
+
+Instrumented code checks metrics.enabled before taking any timestamps, so
+this costs a single attribute lookup per stage when switched off. Stages:
+
+    decode      sniffing and decoding a frame from the game
+    handler     a status frame waiting for (and getting to) its handler
+    dispatch    fanning a map event out to its lights
+    route       looking up which lights an event goes to
+    render      one renderer tick
+    translate   turning a light state into its payload
+    send        handing a payload to a light (Hue: the whole HTTP request; WiZ: until acked)
+    ack         WiZ fire-and-forget acks
+    loop_lag    how late the event loop runs a timer
+
+Everything can be read as Prometheus text from a local HTTP endpoint and is
+logged as a summary periodically. '''
+
+import asyncio
+import bisect
+import math
+import time
+
+from . import logger
+
+
+enabled = False
+now = time.perf_counter
+
+
+class Histogram(object):
+    ''' Latency histogram (in seconds) with fixed, roughly logarithmic buckets '''
+
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+               0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, math.inf)
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        ''' Upper bound of the bucket holding the q-th quantile '''
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+
+stages = {}
+counters = {}
+collectors = {}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    stages.clear()
+    counters.clear()
+
+
+def observe(stage, seconds):
+    histogram = stages.get(stage)
+    if histogram is None:
+        histogram = stages[stage] = Histogram()
+    histogram.observe(seconds)
+
+
+def count(name, n=1):
+    counters[name] = counters.get(name, 0) + n
+
+
+def register(name, stats):
+    ''' Export the numbers from a stats() callable (e.g. Renderer.stats) as gauges '''
+    collectors[name] = stats
+
+
+def summary():
+    lines = []
+    for stage, histogram in sorted(stages.items()):
+        lines.append('%-10s n=%-7d mean %7.2fms  p50 %7.2fms  p99 %7.2fms  max %7.2fms' % (
+            stage, histogram.count, 1000 * histogram.mean(), 1000 * histogram.quantile(0.5),
+            1000 * histogram.quantile(0.99), 1000 * histogram.max))
+    if counters:
+        lines.append(' '.join('%s=%d' % item for item in sorted(counters.items())))
+    return '\n'.join(lines)
+
+
+def exposition():
+    ''' Everything we know, in the Prometheus text format '''
+    lines = ['# TYPE clubsaber_stage_seconds histogram']
+    for stage, histogram in sorted(stages.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            le = '+Inf' if bound == math.inf else repr(bound)
+            lines.append('clubsaber_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, le, cumulative))
+        lines.append('clubsaber_stage_seconds_sum{stage="%s"} %f' % (stage, histogram.sum))
+        lines.append('clubsaber_stage_seconds_count{stage="%s"} %d' % (stage, histogram.count))
+
+    lines.append('# TYPE clubsaber_events_total counter')
+    for name, value in sorted(counters.items()):
+        lines.append('clubsaber_events_total{name="%s"} %d' % (name, value))
+
+    lines.append('# TYPE clubsaber_stat gauge')
+    for name, stats in sorted(collectors.items()):
+        try:
+            values = stats()
+        except Exception as e:
+            logger.debug('Failed to collect %s: %s', name, e)
+            continue
+        for key, value in sorted(values.items()):
+            if isinstance(value, (int, float)):
+                lines.append('clubsaber_stat{source="%s",stat="%s"} %s' % (name, key, float(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+async def _serve(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = exposition().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+
+async def monitor_loop_lag(interval=0.05):
+    ''' Measure how much later than asked the loop gets round to waking us '''
+    while True:
+        expected = now() + interval
+        await asyncio.sleep(interval)
+        if enabled:
+            observe('loop_lag', max(0.0, now() - expected))
+
+
+async def run(port=0, interval=30.0, host='127.0.0.1'):
+    ''' Collect metrics until cancelled: serve them on port (if set) and log a summary every interval '''
+    enable()
+    lag = asyncio.create_task(monitor_loop_lag())
+    server = None
+    try:
+        if port:
+            server = await asyncio.start_server(_serve, host, port)
+            logger.info('Serving metrics on http://%s:%d/metrics', host, port)
+
+        while True:
+            await asyncio.sleep(interval or 3600)
+            if interval:
+                logger.info('Pipeline timings:\n%s', summary())
+    finally:
+        lag.cancel()
+        if server is not None:
+            server.close()
+        disable()
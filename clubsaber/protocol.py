@@ -0,0 +1,91 @@
+import json
+import re
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+# Status frames larger than this are decoded in a worker process
+OFFLOAD_SIZE = 256 * 1024
+
+# The game writes the event name first, so a frame can be classified from its head
+_event = re.compile(r'\{\s*"event"\s*:\s*"(\w+)"')
+_map_event = re.compile(
+    r'"beatmapEvent"\s*:\s*\{\s*"type"\s*:\s*(-?\d+)\s*,\s*"value"\s*:\s*(-?\d+)')
+
+# Base64 blobs which dwarf the rest of a status frame and that we never look at
+_blobs = re.compile(r'"(songCover|coverImage)"\s*:\s*"[^"]*"')
+
+
+def sniff(packet):
+    ''' Find the event name of a frame without decoding it; None if it isn't cheaply found '''
+    if not isinstance(packet, str):
+        # Binary frames are rare enough to just take the full decode
+        return None
+    match = _event.match(packet)
+    return match.group(1) if match else None
+
+
+def scan_map_event(packet):
+    ''' Pull (type, value) out of a beatmapEvent frame with a regex; None if it isn't laid out as expected '''
+    match = _map_event.search(packet)
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def parse_map_event(packet):
+    ''' Pull (type, value) out of a beatmapEvent frame with the JSON backend; None if it's malformed '''
+    return map_event_fields(loads(packet))
+
+
+def map_event_fields(data):
+    event = data.get('beatmapEvent')
+    if not isinstance(event, dict) or 'type' not in event or 'value' not in event:
+        return None
+    return event['type'], event['value']
+
+
+# orjson parses these small frames faster than the regex can scan them, while
+# the stdlib parser is several times slower (see benchmarks/decode.py)
+decode_map_event = parse_map_event if loads is not json.loads else scan_map_event
+
+
+def decode(packet):
+    ''' Fully decode a frame, returning (event, data) '''
+    data = loads(packet)
+    return data.get('event'), data
+
+
+_beatmap_fields = (
+    'songName', 'songSubName', 'songAuthorName', 'difficulty', 'songBPM', 'color',
+)
+
+
+def decode_status(packet):
+    ''' Decode a status frame, keeping only the fields the club uses.
+
+    This can take a while on frames carrying cover art, so large frames
+    should be handed to a worker process; only the slimmed down fields come back. '''
+    if not isinstance(packet, str):
+        packet = bytes(packet).decode('utf-8', 'replace')
+    if len(packet) > OFFLOAD_SIZE:
+        packet = _blobs.sub(r'"\1":null', packet)
+
+    event, data = decode(packet)
+
+    status = data.get('status')
+    if not isinstance(status, dict):
+        return event, data
+
+    slim = {k: v for k, v in status.items() if k in ('songBPM', 'performance')}
+
+    beatmap = status.get('beatmap')
+    if isinstance(beatmap, dict):
+        slim['beatmap'] = {k: beatmap[k] for k in _beatmap_fields if k in beatmap}
+
+    data['status'] = slim
+    return event, data
@@ -0,0 +1,94 @@
+import asyncio
+
+from . import logger
+
+
+class CommandQueue(object):
+    ''' Single-writer outbound queue for one light.
+
+    Only one send is ever in flight; anything queued behind it is collapsed
+    so that the newest target state is the one transmitted when the link
+    frees up. With a limiter (a TokenBucket), sends also wait for a token,
+    and updates arriving in the meantime are merged the same way. '''
+
+    def __init__(self, send, name=None, limiter=None):
+        self.send = send
+        self.name = name
+        self.limiter = limiter
+
+        self.pending = None
+        self.waiters = []
+        self.writer = None
+
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def put(self, state):
+        ''' Queue a state, replacing any state not yet sent.
+        Returns a future which resolves once a state at least this new has gone out '''
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = state
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+
+        if not self.writer or self.writer.done():
+            self.writer = asyncio.create_task(self._drain())
+
+        return future
+
+    def discard(self):
+        ''' Drop any state not yet sent, e.g. because it was delivered some other way '''
+        if self.pending is None:
+            return
+        self.pending = None
+
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def busy(self):
+        return self.writer is not None and not self.writer.done()
+
+    async def _drain(self):
+        while self.pending is not None:
+            if self.limiter is not None:
+                await self.limiter.acquire()
+                # It may have been delivered some other way while we waited
+                if self.pending is None:
+                    self.limiter.refund()
+                    break
+
+            state, self.pending = self.pending, None
+            waiters, self.waiters = self.waiters, []
+
+            try:
+                # Senders return False for states they chose not to transmit
+                if await self.send(state) is False:
+                    self.dropped += 1
+                    if self.limiter is not None:
+                        self.limiter.refund()
+                else:
+                    self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                logger.warning('Failed to update %s: %s', self.name, e)
+            finally:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+
+    def stats(self):
+        stats = {
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+        if self.limiter is not None:
+            stats['throttled'] = self.limiter.throttled
+        return stats
@@ -0,0 +1,131 @@
+import asyncio
+import math
+import statistics
+import time
+
+from . import logger
+
+
+class TokenBucket(object):
+    ''' Allows rate commands per second on average, in bursts of up to burst '''
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+
+        self.tokens = burst
+        self.updated = clock()
+        self.throttled = 0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        ''' Seconds until a token is free; 0 if one is free now '''
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        delay = self.delay()
+        if delay:
+            self.throttled += 1
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self.delay()
+        self.tokens -= 1
+
+    def refund(self):
+        ''' Give back a token that ended up not being used '''
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+# Commands per second to try, in order, when calibrating a light
+CALIBRATION_RATES = (2, 4, 6, 8, 12, 16, 24, 32, 48, 64)
+
+
+async def calibrate(light, rates=CALIBRATION_RATES, window=2.0, max_loss=0.05,
+                    max_slowdown=3.0, jitter=0.05, headroom=0.8):
+    ''' Ramp up commands to a light until it starts losing them or slowing down
+    (taking max_slowdown times as long as at the slowest rate, and more than
+    jitter seconds longer).
+
+    Returns headroom times the fastest rate the light kept up with, or None if
+    it couldn't even manage the slowest. '''
+    payloads = (light.payload(True, (255, 0, 0), 1.0, 1.0),
+                light.payload(True, (0, 0, 255), 1.0, 1.0))
+
+    baseline = None
+    best = None
+    for rate in rates:
+        latencies, lost = await _ramp(light, rate, window, payloads)
+        loss = lost / (len(latencies) + lost)
+        latency = statistics.median(latencies) if latencies else math.inf
+        if baseline is None:
+            baseline = latency
+
+        logger.info('%s at %g/s: %.0f%% lost, median latency %.1fms',
+                    light.get_id(), rate, 100 * loss, 1000 * latency)
+        if loss > max_loss or latency > max(max_slowdown * baseline, baseline + jitter):
+            break
+        best = rate
+
+    return best * headroom if best else None
+
+
+async def calibrate_lights(lights, **kwargs):
+    ''' Calibrate each light, returning light ID -> rate (None if it couldn't keep up at all).
+
+    A Hue bridge limits the commands for all its lights together, and trips its
+    circuit breaker for all of them, so one light per bridge is ramped up and
+    the rate it reached is split between the bridge's lights. '''
+    rates = {}
+    by_bridge = {}
+    for light in lights:
+        bridge = light.batcher()
+        if bridge is None:
+            rates[light.get_id()] = await calibrate(light, **kwargs)
+        else:
+            by_bridge.setdefault(bridge, []).append(light)
+
+    for bridge, bridge_lights in by_bridge.items():
+        # Measure the bridge itself, not whatever limits we set on it last time
+        for light in bridge_lights:
+            light.set_rate(None)
+        bridge.reset()
+        rate = await calibrate(bridge_lights[0], **kwargs)
+        # Don't make the next show pay for our pushing the bridge over the edge
+        bridge.reset()
+        for light in bridge_lights:
+            rates[light.get_id()] = rate / len(bridge_lights) if rate else None
+
+    return rates
+
+
+async def _ramp(light, rate, window, payloads):
+    latencies = []
+    lost = 0
+
+    async def probe(payload):
+        nonlocal lost
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(light.probe(payload), 1.0)
+        except Exception as e:
+            logger.debug('%s lost a probe: %s', light.get_id(), e)
+            lost += 1
+        else:
+            latencies.append(time.monotonic() - start)
+
+    probes = []
+    start = time.monotonic()
+    for n in range(max(1, int(rate * window))):
+        await asyncio.sleep(max(0.0, start + n / rate - time.monotonic()))
+        probes.append(asyncio.create_task(probe(payloads[n % len(payloads)])))
+    await asyncio.gather(*probes)
+
+    return latencies, lost
@@ -0,0 +1,151 @@
+''' Record the frames the game sends us, and play them back later without the game.
+
+A recording is a header followed by an append-only series of records, each
+a '<BdI' (kind, seconds since recording started, length) and then length
+bytes of payload. Status frames repeat the same base64 cover image over and
+over, so large blobs are written once as a BLOB record (8-byte hash, then the
+blob) and frames refer to them by hash instead. '''
+
+import asyncio
+import hashlib
+import mmap
+import re
+import struct
+import time
+
+from . import logger
+
+
+MAGIC = b'CLUBSABR'
+VERSION = 1
+
+_header = struct.Struct('<HHd')
+_record = struct.Struct('<BdI')
+
+TEXT = 0
+BLOB = 1
+BINARY = 2
+
+# Blobs shorter than this aren't worth deduplicating
+BLOB_SIZE = 1024
+
+_blobs = re.compile(rb'("(?:songCover|coverImage)"\s*:\s*")([^"]{%d,})"' % BLOB_SIZE)
+_refs = re.compile(rb'("(?:songCover|coverImage)"\s*:\s*")@blob:([0-9a-f]{16})"')
+
+
+class Recorder(object):
+    ''' Appends frames to a recording as they arrive '''
+
+    def __init__(self, path, clock=time.monotonic):
+        self.path = path
+        self.clock = clock
+        self.start = clock()
+        self.blobs = set()
+
+        self.frames = 0
+        self.bytes = 0
+
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + _header.pack(VERSION, 0, time.time()))
+
+    def record(self, packet):
+        at = self.clock() - self.start
+        if isinstance(packet, str):
+            kind, data = TEXT, packet.encode()
+            data = _blobs.sub(lambda match: self._blob(at, match), data)
+        else:
+            kind, data = BINARY, packet
+
+        self._write(kind, at, data)
+        self.frames += 1
+
+    def _blob(self, at, match):
+        blob = match.group(2)
+        key = hashlib.blake2b(blob, digest_size=8).digest()
+        if key not in self.blobs:
+            self.blobs.add(key)
+            self._write(BLOB, at, key + blob)
+        return match.group(1) + b'@blob:' + key.hex().encode() + b'"'
+
+    def _write(self, kind, at, data):
+        self.file.write(_record.pack(kind, at, len(data)))
+        self.file.write(data)
+        self.bytes += _record.size + len(data)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            logger.info('Recorded %d frames (%d bytes) to %s', self.frames, self.bytes, self.path)
+
+
+class Recording(object):
+    ''' A recording, mapped into memory; iterating it gives (seconds, frame) '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as recording_file:
+            self.map = mmap.mmap(recording_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError('%s is not a club-saber recording' % path)
+
+        version, _, self.started = _header.unpack_from(self.map, len(MAGIC))
+        if version != VERSION:
+            self.map.close()
+            raise ValueError('%s is an unsupported recording (version %d)' % (path, version))
+
+        self.offset = len(MAGIC) + _header.size
+
+    def __iter__(self):
+        blobs = {}
+        offset = self.offset
+        end = len(self.map)
+
+        while offset + _record.size <= end:
+            kind, at, length = _record.unpack_from(self.map, offset)
+            offset += _record.size
+            if offset + length > end:
+                logger.warning('%s is truncated', self.path)
+                return
+            data = self.map[offset:offset + length]
+            offset += length
+
+            if kind == BLOB:
+                blobs[data[:8].hex().encode()] = data[8:]
+            elif kind == TEXT:
+                if b'@blob:' in data:
+                    data = _refs.sub(lambda match: match.group(1) + blobs[match.group(2)] + b'"', data)
+                yield at, data.decode()
+            elif kind == BINARY:
+                yield at, data
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+async def replay(club, recording, speed=1.0):
+    ''' Feed a recording through the club's handlers at speed times real time (0 for flat out) '''
+    start = time.monotonic()
+    frames = 0
+    for at, packet in recording:
+        if speed:
+            delay = start + at / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # Still let rendering and handlers run between frames
+            await asyncio.sleep(0)
+
+        club.receive(packet)
+        frames += 1
+
+    elapsed = time.monotonic() - start
+    logger.info('Replayed %d frames in %.2fs', frames, elapsed)
+    return frames, elapsed
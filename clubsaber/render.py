@@ -0,0 +1,208 @@
+import array
+import asyncio
+import time
+
+from . import logger
+from . import metrics
+from .light import Light
+
+
+class Renderer(object):
+    ''' Fixed-tick frame renderer.
+
+    Effects write the target state for each light into a compact frame
+    (on, rgb, brightness, speed) or play an envelope against it. Once per
+    tick, envelopes are advanced and only the lights whose state actually
+    changed since the last frame are sent.
+
+    Bulbs can drift from what we last told them (or miss it altogether), so
+    every so often each light is asked to send again whatever it last sent,
+    if it has sent nothing for refresh_interval seconds. That covers states
+    that went out without passing through here too, like compiled schedules. '''
+
+    def __init__(self, lights=(), rate=30, clock=time.monotonic, refresh_interval=None):
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.clock = clock
+        self.refresh_interval = refresh_interval
+        self.next_refresh = 0.0
+
+        self.frames = 0
+        self.emitted = 0
+        self.refreshed = 0
+        self.cancelled = 0
+        self.overwritten = 0
+        self.task = None
+
+        self.set_lights(lights)
+
+    def set_lights(self, lights):
+        ''' Switch to a new set of lights, carrying over the state of any we already had '''
+        old = self.__dict__.copy() if hasattr(self, 'lights') else None
+
+        self.lights = list(lights)
+        self.index = {light: idx for idx, light in enumerate(self.lights)}
+
+        count = len(self.lights)
+        self.on = array.array('B', bytes(count))
+        self.rgb = array.array('d', bytes(8 * 3 * count))
+        self.brightness = array.array('d', bytes(8 * count))
+        self.speed = array.array('d', [0.5] * count)
+
+        self.sent = [None] * count
+        self.envelopes = [None] * count
+        self.animating = set()
+        self.dirty = set()
+
+        if not old:
+            return
+
+        for idx, light in enumerate(self.lights):
+            prev = old['index'].get(light)
+            if prev is None:
+                continue
+
+            self.on[idx] = old['on'][prev]
+            self.rgb[3 * idx:3 * idx + 3] = old['rgb'][3 * prev:3 * prev + 3]
+            self.brightness[idx] = old['brightness'][prev]
+            self.speed[idx] = old['speed'][prev]
+            self.sent[idx] = old['sent'][prev]
+            self.envelopes[idx] = old['envelopes'][prev]
+
+            if self.envelopes[idx] is not None:
+                self.animating.add(idx)
+            if prev in old['dirty']:
+                self.dirty.add(idx)
+
+    def set(self, idx, **state):
+        ''' Write a light's target state into the current frame, superseding any envelope '''
+        self._supersede(idx)
+        self._write(idx, **state)
+
+    def _write(self, idx, on=True, rgb=None, brightness=None, speed=None):
+        if idx in self.dirty:
+            # Replacing a state this frame hasn't sent yet
+            self.overwritten += 1
+        self.on[idx] = on
+        if rgb is not None:
+            self.rgb[3 * idx:3 * idx + 3] = array.array('d', rgb)
+        if brightness is not None:
+            self.brightness[idx] = brightness
+        if speed is not None:
+            self.speed[idx] = speed
+        self.dirty.add(idx)
+
+    def set_all(self, **state):
+        for idx in range(len(self.lights)):
+            self.set(idx, **state)
+
+    def play(self, idx, envelope):
+        ''' Start an envelope on a light, cancelling whatever it was still playing '''
+        self._supersede(idx)
+
+        envelope.begin(self.clock())
+        self.envelopes[idx] = envelope
+        self._advance(idx, envelope.start)
+
+    def _supersede(self, idx):
+        envelope = self.envelopes[idx]
+        if envelope is not None:
+            self.cancelled += envelope.cancel()
+            self.envelopes[idx] = None
+            self.animating.discard(idx)
+
+    def _advance(self, idx, now):
+        envelope = self.envelopes[idx]
+        state = envelope.advance(now)
+        if state is not None:
+            self._write(idx, **state)
+
+        if envelope.done():
+            self.envelopes[idx] = None
+            self.animating.discard(idx)
+        else:
+            self.animating.add(idx)
+
+    def tick(self, now=None):
+        ''' Advance envelopes up to now and emit every light that changed '''
+        if now is None:
+            now = self.clock()
+        if metrics.enabled:
+            ticking = metrics.now()
+
+        for idx in tuple(self.animating):
+            self._advance(idx, now)
+
+        updates = []
+        for idx in self.dirty:
+            update = self._emit(idx)
+            if update:
+                updates.append(update)
+        self.dirty.clear()
+
+        if updates:
+            Light.dispatch(updates)
+
+        if self.refresh_interval and now >= self.next_refresh:
+            self._refresh(now)
+
+        self.frames += 1
+        if metrics.enabled:
+            metrics.observe('render', metrics.now() - ticking)
+
+    def _emit(self, idx):
+        if self.on[idx]:
+            rgb = tuple(self.rgb[3 * idx:3 * idx + 3])
+            state = (True, rgb, self.brightness[idx], self.speed[idx])
+        else:
+            state = (False,)
+
+        if state == self.sent[idx]:
+            return None
+        self.sent[idx] = state
+        self.emitted += 1
+
+        if state[0]:
+            return self.lights[idx], dict(rgb=state[1], brightness=state[2], speed=state[3])
+        return self.lights[idx], dict(on=False)
+
+    def _refresh(self, now):
+        # Checking a few times per interval is plenty; nobody will notice a drift being fixed late
+        self.next_refresh = now + self.refresh_interval / 4
+        for light in self.lights:
+            if light.refresh(now):
+                self.refreshed += 1
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'emitted': self.emitted,
+            'refreshed': self.refreshed,
+            'cancelled': self.cancelled,
+            'overwritten': self.overwritten,
+        }
+
+    def start(self):
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        deadline = self.clock()
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                logger.exception('Failed to render frame: %s', e)
+
+            deadline += self.period
+            delay = deadline - self.clock()
+            if delay < 0:
+                # We've fallen behind; drop the missed frames rather than bursting
+                deadline = self.clock()
+                delay = 0
+            await asyncio.sleep(delay)
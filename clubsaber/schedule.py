@@ -0,0 +1,250 @@
+''' Light shows compiled ahead of time from a beatmap.
+
+Compiling runs every event through routing and its envelope once, offline,
+leaving each light a time-sorted list of the states it should show, with
+repeats and states overridden within a frame already dropped. Every state is
+translated to each light type's wire payload at the same time. Playing a
+schedule back is then just streaming it against the song clock.
+
+Schedules are saved as a small JSON header (lights, states and payloads)
+followed by each light's times ('d') and state indices ('H') as raw arrays,
+and cached by a hash of everything that went into them. '''
+
+import array
+import asyncio
+import hashlib
+import heapq
+import json
+import os
+import struct
+
+import appdirs
+
+from . import envelope
+from . import logger
+from . import metrics
+from .envelope import OFF
+from .light import Light
+
+
+MAGIC = b'CLUBSCHD'
+VERSION = 1
+
+_header = struct.Struct('<HI')
+
+OFF_STATE = (False,)
+
+
+class Schedule(object):
+    def __init__(self, lights, states, payloads, timelines):
+        # Light descriptions, one per timeline
+        self.lights = lights
+        # (False,) or (True, rgb, brightness, speed)
+        self.states = states
+        # Light class name -> a payload per state
+        self.payloads = payloads
+        # Per light, (times, state indices)
+        self.timelines = timelines
+
+        self.updates = [dict(on = False) if not state[0] else
+                        dict(rgb = state[1], brightness = state[2], speed = state[3])
+                        for state in states]
+
+    @classmethod
+    def compile(cls, events, lights, config, red, blue, resolution=0.0, balancer=None):
+        ''' Compile (seconds, type, value) events for these lights, as routed by config
+        (and spread by balancer, if given).
+
+        Changes to a light less than resolution apart are merged, keeping the
+        newest, the same way the renderer would within one frame. '''
+        if balancer is not None:
+            balancer = balancer.fork()
+
+        hits = [[] for _ in lights]
+        for at, etype, value in events:
+            effect = envelope.for_light_value(value, red, blue)
+            indices = config.get_light_indices_for_event(lights, etype)
+            if balancer is not None:
+                indices = balancer.choose(etype, value, tuple(indices), lights, now=at)
+            if effect is None:
+                continue
+            for idx in indices:
+                hits[idx].append((at, effect))
+
+        states = {}
+        timelines = []
+        for light_hits in hits:
+            times = array.array('d')
+            indices = array.array('H')
+
+            for n, (at, effect) in enumerate(light_hits):
+                # The next effect on this light cancels whatever is left of this one
+                until = light_hits[n + 1][0] if n + 1 < len(light_hits) else None
+
+                for delay, brightness, speed in effect.keyframes:
+                    when = at + delay
+                    if until is not None and when >= until:
+                        break
+
+                    state = OFF_STATE if brightness == OFF else \
+                            (True, tuple(effect.rgb), brightness, speed)
+                    index = states.setdefault(state, len(states))
+
+                    if times and when - times[-1] < resolution:
+                        times.pop()
+                        indices.pop()
+                    if indices and indices[-1] == index:
+                        continue
+                    times.append(when)
+                    indices.append(index)
+
+            timelines.append((times, indices))
+
+        states = list(states)
+        payloads = {}
+        for light in lights:
+            kind = type(light)
+            if kind.__name__ not in payloads:
+                payloads[kind.__name__] = [
+                    kind.payload(on = False) if not state[0] else kind.payload(*state)
+                    for state in states]
+
+        return cls([light.describe() for light in lights], states, payloads, timelines)
+
+    @staticmethod
+    def key(events, lights, config, red, blue, resolution=0.0, balancer=None):
+        ''' A hash of everything that goes into compiling a schedule '''
+        digest = hashlib.sha256()
+        digest.update(json.dumps([
+            VERSION,
+            [light.describe() for light in lights],
+            config.get('lights_ignored', []),
+            config.get('light_event_map', {}),
+            list(red), list(blue), resolution,
+            balancer.describe() if balancer is not None else None,
+        ], sort_keys=True).encode())
+        digest.update(json.dumps(events).encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def cached(cls, events, lights, config, red, blue, resolution=0.0, balancer=None):
+        ''' Load the compiled schedule from the cache, compiling (and caching) it if need be '''
+        key = cls.key(events, lights, config, red, blue, resolution, balancer)
+        path = os.path.join(appdirs.user_cache_dir('club-saber'), 'schedules', key + '.schedule')
+
+        try:
+            return cls.load(path)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning('Recompiling unreadable schedule %s: %s', path, e)
+
+        schedule = cls.compile(events, lights, config, red, blue, resolution, balancer)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            schedule.save(path)
+        except OSError as e:
+            logger.warning('Failed to cache schedule %s: %s', path, e)
+        return schedule
+
+    def save(self, path):
+        header = json.dumps({
+            'lights': self.lights,
+            'states': self.states,
+            'payloads': self.payloads,
+            'lengths': [len(times) for times, _ in self.timelines],
+        }).encode()
+
+        # Write alongside and move into place, so a reader never sees half a schedule
+        with open(path + '.tmp', 'wb') as schedule_file:
+            schedule_file.write(MAGIC + _header.pack(VERSION, len(header)) + header)
+            for times, indices in self.timelines:
+                times.tofile(schedule_file)
+                indices.tofile(schedule_file)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as schedule_file:
+            data = schedule_file.read()
+
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a schedule' % path)
+        version, length = _header.unpack_from(data, len(MAGIC))
+        if version != VERSION:
+            raise ValueError('%s is an unsupported schedule (version %d)' % (path, version))
+
+        offset = len(MAGIC) + _header.size
+        header = json.loads(data[offset:offset + length])
+        offset += length
+
+        timelines = []
+        for count in header['lengths']:
+            times = array.array('d')
+            times.frombytes(data[offset:offset + 8 * count])
+            offset += 8 * count
+            indices = array.array('H')
+            indices.frombytes(data[offset:offset + 2 * count])
+            offset += 2 * count
+            timelines.append((times, indices))
+
+        states = [OFF_STATE if not state[0] else (True, tuple(state[1]), state[2], state[3])
+                  for state in header['states']]
+        return cls(header['lights'], states, header['payloads'], timelines)
+
+    def bind(self, lights):
+        ''' Match our timelines to these lights, and hand them our precompiled payloads '''
+        by_description = {json.dumps(light.describe(), sort_keys=True): light for light in lights}
+        bound = [by_description.get(json.dumps(description, sort_keys=True))
+                 for description in self.lights]
+
+        for kind in {type(light) for light in bound if light is not None}:
+            payloads = self.payloads.get(kind.__name__)
+            if not payloads:
+                continue
+            for state, payload in zip(self.states, payloads):
+                if state[0]:
+                    kind.palette[state] = payload
+
+        return bound
+
+    def __len__(self):
+        return sum(len(times) for times, _ in self.timelines)
+
+    async def play(self, clock, lights, lead=None):
+        ''' Stream every light's timeline to it against the song clock, lead(light) seconds early '''
+        bound = self.bind(lights)
+        if lead is None:
+            lead = lambda light: 0.0
+
+        pending = [(times[0] - lead(bound[idx]), idx, 0)
+                   for idx, (times, _) in enumerate(self.timelines)
+                   if times and bound[idx] is not None]
+        heapq.heapify(pending)
+
+        while pending:
+            clock.sync()
+            now = clock.now()
+
+            due = pending[0][0]
+            if due > now:
+                await asyncio.sleep(min(due - now, clock.sync_interval))
+                continue
+
+            updates = []
+            while pending and pending[0][0] <= now:
+                _, idx, position = heapq.heappop(pending)
+                light = bound[idx]
+                times, indices = self.timelines[idx]
+
+                updates.append((light, self.updates[indices[position]]))
+                lateness = now + lead(light) - times[position]
+                clock.lateness.append(lateness)
+                if metrics.enabled:
+                    metrics.observe('lateness', max(0.0, lateness))
+
+                position += 1
+                if position < len(times):
+                    heapq.heappush(pending, (times[position] - lead(light), idx, position))
+
+            Light.dispatch(updates)
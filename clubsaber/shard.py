@@ -0,0 +1,285 @@
+''' Driving lights from worker processes, for installations too big for one core.
+
+The main process keeps the websocket, decoding and rendering, and lights are
+split across light_shards workers, each owning the transports (WiZ socket,
+Hue bridge connections) for its lights. Lights on the same Hue bridge always
+share a worker so group actions still work.
+
+Each rendered frame goes to a worker as one message over a pipe: a tag byte
+and a packed '<HBddddd' (slot, on, r, g, b, brightness, speed) per light.
+Workers send back a stats snapshot every second, so a stalled bridge in one
+worker holds up only that worker. '''
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import struct
+import threading
+
+from . import logger
+from .config import Config
+from .inventory import Inventory
+from .light import Light
+
+
+FRAME = b'F'
+PALETTE = b'P'
+STATS = b'S'
+QUIT = b'Q'
+
+_update = struct.Struct('<HBddddd')
+
+# How often (in seconds) workers report their lights' stats
+STATS_INTERVAL = 1.0
+
+
+def encode_frame(updates):
+    ''' Pack (slot, state) updates into one frame '''
+    frame = bytearray(FRAME)
+    for slot, state in updates:
+        if state.get('on', True):
+            r, g, b = state.get('rgb') or (255, 255, 255)
+            frame += _update.pack(slot, 1, r, g, b,
+                                  state.get('brightness', 1.0), state.get('speed', 0.5))
+        else:
+            frame += _update.pack(slot, 0, 0, 0, 0, 0, 0)
+    return bytes(frame)
+
+
+def decode_frame(frame):
+    for slot, on, r, g, b, brightness, speed in _update.iter_unpack(memoryview(frame)[1:]):
+        if on:
+            yield slot, dict(rgb = (r, g, b), brightness = brightness, speed = speed)
+        else:
+            yield slot, dict(on = False)
+
+
+class ShardProxy(Light):
+    ''' Stands in for a light which lives in a worker process '''
+
+    def __init__(self, shard, slot, description, config):
+        self.shard = shard
+        self.slot = slot
+        self.description = description
+        super().__init__(config)
+
+    def get_id(self):
+        return self.description['id']
+
+    def describe(self):
+        return self.description
+
+    def batcher(self):
+        return self.shard
+
+    def update(self, **state):
+        self.shard.dispatch([(self, state)])
+
+    def stats(self):
+        return self.shard.light_stats(self.slot)
+
+    def latency(self):
+        return self.stats().get('latency', 0.0)
+
+    @staticmethod
+    def translate(on=True, rgb=(255, 255, 255), brightness=1.0, speed=0.5):
+        # The worker translates for the real light; nothing goes on the wire from here
+        return (on, rgb, brightness, speed)
+
+
+class Shard(object):
+    ''' One worker process and the lights it drives '''
+
+    def __init__(self, index, descriptions, bridges, config):
+        self.id = 'shard-%d' % index
+        self.lights = [ShardProxy(self, slot, description, config)
+                       for slot, description in enumerate(descriptions)]
+
+        self.snapshot = {}
+        self.frames = 0
+        self.bytes = 0
+        self.failed = 0
+
+        context = multiprocessing.get_context('spawn')
+        self.conn, child = context.Pipe()
+        self.process = context.Process(
+            target = _work, name = 'clubsaber-%s' % self.id, daemon = True,
+            args = (child, config.overrides, descriptions, bridges, logging.getLogger().level))
+        self.process.start()
+        child.close()
+
+        self.reader = threading.Thread(target=self._read, name='%s-reader' % self.id, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        while True:
+            try:
+                data = self.conn.recv_bytes()
+            except (EOFError, OSError):
+                return
+            if data[:1] == STATS:
+                self.snapshot = json.loads(data[1:])
+
+    def _send(self, data):
+        try:
+            self.conn.send_bytes(data)
+        except (BrokenPipeError, OSError) as e:
+            self.failed += 1
+            logger.warning('Lost %s: %s', self.id, e)
+            return
+        self.frames += 1
+        self.bytes += len(data)
+
+    def dispatch(self, updates):
+        self._send(encode_frame([(light.slot, state) for light, state in updates]))
+
+    def build_palettes(self, states):
+        self._send(PALETTE + json.dumps([[list(rgb), brightness, speed]
+                                         for rgb, brightness, speed in states]).encode())
+
+    def light_stats(self, slot):
+        lights = self.snapshot.get('lights', [])
+        return lights[slot] if slot < len(lights) else {}
+
+    def stats(self):
+        return dict(self.snapshot.get('bridges', {}),
+                    frames = self.frames, bytes = self.bytes, failed = self.failed,
+                    alive = self.process.is_alive())
+
+    def close(self):
+        self._send(QUIT)
+        self.process.join(timeout=2.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class ShardPool(object):
+    ''' Splits lights across worker processes, swapping them for proxies '''
+
+    def __init__(self, count, config, bridges):
+        self.count = count
+        self.config = config
+        self.bridges = bridges
+        self.shards = []
+        self.states = None
+
+    def assign(self, lights):
+        ''' Return proxies for these lights, restarting the workers if the set of lights changed '''
+        current = [light for shard in self.shards for light in shard.lights]
+        if len(lights) == len(current) and all(isinstance(light, ShardProxy) for light in lights) \
+                and set(lights) == set(current):
+            return lights
+
+        descriptions = [light.describe() for light in lights]
+        self.close()
+
+        # Lights on one bridge stay together; otherwise fill up the emptiest worker
+        groups = {}
+        for description in descriptions:
+            groups.setdefault(description.get('bridge') or description['id'], []).append(description)
+        slots = [[] for _ in range(min(self.count, len(groups)))]
+        for group in sorted(groups.values(), key=len, reverse=True):
+            min(slots, key=len).extend(group)
+
+        bridges = {id: bridge.describe() for id, bridge in self.bridges.items()}
+        self.shards = [Shard(index, shard_descriptions, bridges, self.config)
+                       for index, shard_descriptions in enumerate(slots)]
+        if self.states is not None:
+            for shard in self.shards:
+                shard.build_palettes(self.states)
+
+        logger.info('Driving %d lights from %d workers', len(lights), len(self.shards))
+
+        proxies = {json.dumps(light.describe(), sort_keys=True): light
+                   for shard in self.shards for light in shard.lights}
+        return [proxies[json.dumps(description, sort_keys=True)] for description in descriptions]
+
+    def build_palettes(self, states):
+        self.states = states
+        for shard in self.shards:
+            shard.build_palettes(states)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.shards = []
+
+
+def _work(conn, overrides, descriptions, bridges, level):
+    logging.basicConfig(level=level or logging.WARNING)
+    try:
+        asyncio.run(_serve(conn, overrides, descriptions, bridges))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve(conn, overrides, descriptions, bridges):
+    config = Config(**overrides)
+    lights = Inventory.recreate({'lights': descriptions, 'bridges': bridges}, config, {})
+    for description, light in zip(descriptions, lights):
+        if light is None:
+            logger.warning('Unable to drive %s from a worker', description)
+
+    # Reading the pipe blocks, so it gets a thread of its own
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+
+    def read():
+        while True:
+            try:
+                data = conn.recv_bytes()
+            except (EOFError, OSError):
+                data = QUIT
+            loop.call_soon_threadsafe(inbox.put_nowait, data)
+            if data == QUIT:
+                return
+
+    threading.Thread(target=read, daemon=True).start()
+    reporter = asyncio.create_task(_report(conn, lights))
+    refresher = asyncio.create_task(_refresh(lights, config.get('refresh_interval')))
+
+    try:
+        while True:
+            data = await inbox.get()
+            tag = data[:1]
+            if tag == FRAME:
+                Light.dispatch([(lights[slot], state) for slot, state in decode_frame(data)
+                                if lights[slot] is not None])
+            elif tag == PALETTE:
+                Light.build_palettes([(tuple(rgb), brightness, speed)
+                                      for rgb, brightness, speed in json.loads(data[1:])])
+            elif tag == QUIT:
+                return
+    finally:
+        reporter.cancel()
+        refresher.cancel()
+        for bridge in {light.batcher() for light in lights if light is not None} - {None}:
+            await bridge.close()
+
+
+async def _refresh(lights, interval):
+    # The main process's renderer refreshes proxies, which have nothing to send; the real lights are here
+    if not interval:
+        return
+    while True:
+        await asyncio.sleep(interval / 4)
+        for light in lights:
+            if light is not None:
+                light.refresh()
+
+
+async def _report(conn, lights):
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        bridges = {light.batcher() for light in lights if light is not None} - {None}
+        snapshot = {
+            'lights': [light.stats() if light is not None else {} for light in lights],
+            'bridges': {'%s.%s' % (bridge.id, key): value
+                        for bridge in bridges for key, value in bridge.stats().items()},
+        }
+        try:
+            conn.send_bytes(STATS + json.dumps(snapshot).encode())
+        except (BrokenPipeError, OSError):
+            return
@@ -1,24 +1,38 @@
 #!/usr/bin/env python3
 
+from .beatmap import Beatmap
 from .club import Club
+from .clock import SongClock
+from . import balance
+from .schedule import Schedule
 from .beatsaber import EventType, LightValue
-from pygame import mixer
+from .light import VirtualLight
+from . import logger
 
+import argparse
 import asyncio
 import json
 import logging
 import os
-import re
+import time
+
+try:
+    from pygame import mixer
+except ImportError:
+    # Only needed to play songs out loud; headless simulations do without
+    mixer = None
 
 
 class Simulation(object):
-    def __init__(self, song):
-        logging.getLogger().setLevel(logging.DEBUG)
-        logging.getLogger('pywizlight').setLevel(logging.INFO)
+    def __init__(self, song, headless=False):
+        if not headless:
+            logging.getLogger().setLevel(logging.DEBUG)
+            logging.getLogger('pywizlight').setLevel(logging.INFO)
 
-        self.time = 0
-        self.song_time = 0
+        self.headless = headless
+        self.now = 0.0
         self.club = Club()
+        self.clock = SongClock(position=self._song_position)
 
         if os.path.isdir(song):
             song = os.path.join(song, 'info.dat')
@@ -31,7 +45,7 @@ class Simulation(object):
         for bmset in self.info['difficultyBeatmapSets']:
             for bm in bmset['difficultyBeatmaps']:
                 beatmap = bm['beatmapFilename']
-                self.beatmap = self._load(os.path.join(self.song_dir, beatmap))
+                self.beatmap = Beatmap.load(os.path.join(self.song_dir, beatmap))
                 self.custom.update(bm.get('customData', {}))
                 break
             else:
@@ -42,22 +56,26 @@ class Simulation(object):
         with open(filename) as file:
             return self._process(json.load(file))
 
-    lunder = re.compile('^_')
     def _process(self, obj):
         if type(obj) is dict:
-            return { re.sub(self.lunder, '', k): self._process(v) for k, v in obj.items() }
+            return { k[1:] if k.startswith('_') else k: self._process(v) for k, v in obj.items() }
         elif type(obj) is list:
             return [self._process(item) for item in obj]
         else:
             return obj
 
     async def init(self):
+        if mixer is None:
+            raise RuntimeError('pygame is needed to play songs; try a headless simulation')
         mixer.init()
         song_filename = self.info['songFilename']
         mixer.music.load(os.path.join(self.song_dir, song_filename))
 
         await self.club._init_lights()
+        await self.club.receive_start(self._start_info())
 
+    def _start_info(self):
+        ''' What the game would tell us as the song starts '''
         start_info = {
             'status': {
                 'songBPM': self.bpm,
@@ -80,24 +98,24 @@ class Simulation(object):
             if env1:
                 colors['environment1'] = [255 * env1[k] for k in ('r', 'g', 'b')]
 
-        await self.club.receive_start(start_info)
+        return start_info
 
     async def demo(self):
         ''' Give a little sparkle to show how things are working '''
         await self._simulate([
-            { 'time': 0, 'type': EventType.BACK_LASERS, 'value': LightValue.OFF },
-            { 'time': 0, 'type': EventType.LEFT_LASERS, 'value': LightValue.OFF },
-            { 'time': 0, 'type': EventType.RIGHT_LASERS, 'value': LightValue.OFF },
-            { 'time': 4, 'type': EventType.LEFT_LASERS, 'value': LightValue.BLUE_FADE },
-            { 'time': 4, 'type': EventType.RIGHT_LASERS, 'value': LightValue.RED_FADE },
-            { 'time': 8, 'type': EventType.BACK_LASERS, 'value': LightValue.BLUE_FLASH },
-            { 'time': 10, 'type': EventType.BACK_LASERS, 'value': LightValue.RED_FLASH },
-            { 'time': 12, 'type': EventType.LEFT_LASERS, 'value': LightValue.RED_ON },
-            { 'time': 12, 'type': EventType.RIGHT_LASERS, 'value': LightValue.BLUE_ON },
-            { 'time': 16, 'type': EventType.BACK_LASERS, 'value': LightValue.BLUE_FLASH },
-            { 'time': 18, 'type': EventType.BACK_LASERS, 'value': LightValue.RED_FLASH },
-            { 'time': 20, 'type': EventType.LEFT_LASERS, 'value': LightValue.BLUE_FADE },
-            { 'time': 20, 'type': EventType.RIGHT_LASERS, 'value': LightValue.RED_FADE },
+            (0, EventType.BACK_LASERS, LightValue.OFF),
+            (0, EventType.LEFT_LASERS, LightValue.OFF),
+            (0, EventType.RIGHT_LASERS, LightValue.OFF),
+            (4, EventType.LEFT_LASERS, LightValue.BLUE_FADE),
+            (4, EventType.RIGHT_LASERS, LightValue.RED_FADE),
+            (8, EventType.BACK_LASERS, LightValue.BLUE_FLASH),
+            (10, EventType.BACK_LASERS, LightValue.RED_FLASH),
+            (12, EventType.LEFT_LASERS, LightValue.RED_ON),
+            (12, EventType.RIGHT_LASERS, LightValue.BLUE_ON),
+            (16, EventType.BACK_LASERS, LightValue.BLUE_FLASH),
+            (18, EventType.BACK_LASERS, LightValue.RED_FLASH),
+            (20, EventType.LEFT_LASERS, LightValue.BLUE_FADE),
+            (20, EventType.RIGHT_LASERS, LightValue.RED_FADE),
         ])
 
     async def stress_test(self, bpm = 60):
@@ -122,74 +140,84 @@ class Simulation(object):
         except KeyboardInterrupt:
             return
 
+    @staticmethod
+    def _song_position():
+        ''' Seconds of the song played so far, or None if it isn't playing '''
+        if mixer is None or not mixer.music.get_busy():
+            return None
+        return mixer.music.get_pos() / 1000
+
+    def _route(self, etype, value, at):
+        ''' The lights an event at this point in the song goes to '''
+        lights = self.club.lights
+        indices = self.club.config.get_light_indices_for_event(lights, etype)
+        if self.club.balancer is not None:
+            indices = self.club.balancer.choose(etype, value, indices, lights, now = at)
+        return [lights[idx] for idx in indices]
+
+    def _lead(self, light):
+        ''' How far ahead of the beat to send a light its changes '''
+        # On average, a change waits half a frame for the renderer to pick it up
+        lead = light.latency() + self.club.renderer.period / 2
+        return min(lead, self.club.config.get('max_lookahead'))
+
+    def plan_balance(self, beatmap):
+        ''' Give each busy event type in the map its own share of the lights, if balancing '''
+        balancer = self.club.balancer
+        if balancer is None or not len(beatmap):
+            return None
+
+        config = self.club.config
+        lights = self.club.lights
+        counts = {etype: count for etype, count in beatmap.histogram().items()
+                  if config.get_light_indices_for_event(lights, etype)}
+        light_ids = [light.get_id() for light in lights
+                     if any(light in config.get_lights_for_event(lights, etype) for etype in counts)]
+        duration = (beatmap.event_times[-1] - beatmap.event_times[0]) * 60.0 / self.bpm
+
+        balancer.plan = balance.plan(counts, duration, light_ids, config.get('light_rates'))
+        logger.info('Balancing plan: %s', balancer.plan)
+        return balancer.plan
+
     async def _simulate(self, events):
-        tasks = []
-        self.time = 0
-
-        if not events:
-            try:
-                self._emulate(events)
-            except Exception as e:
-                print(e)
-
-        for event in events:
-            ets = event.get('time', 0)
-            if ets > self.time:
-                dt = (ets - self.time) / self.bpm * 60.0
-                await asyncio.sleep(dt)
-
-                if mixer.music.get_busy():
-                    new_song_time = mixer.music.get_pos()
-                    self.time += (new_song_time - self.song_time) / 1000 * self.bpm / 60
-                    self.song_time = new_song_time
-                else:
-                    self.time = ets
-
-            tasks.append(asyncio.create_task(
-                self.club.receive_map_event({ 'beatmapEvent': event })
-            ))
-
-        asyncio.gather(*tasks)
-
-    def _emulate(self, events):
-        import random
-
-        notes = self.beatmap.get('notes', [])
-        for note in notes:
-            if random.random() < 0.666:
-                if note.get('cutDirection', 0) % 2 == 0:
-                    et = int(EventType.LEFT_LASERS)
-                else:
-                    et = int(EventType.RIGHT_LASERS)
-            else:
-                et = int(random.choice([
-                    EventType.BACK_LASERS,
-                    EventType.RING_LIGHTS,
-                    EventType.ROAD_LIGHTS,
-                    EventType.BOOST_LIGHTS
-                ]))
-
-            if note.get('type', 0) == 0:
-                lv = int(random.choice([
-                    LightValue.BLUE_ON,
-                    LightValue.BLUE_FLASH,
-                    LightValue.BLUE_FADE
-                ]))
-            else:
-                lv = int(random.choice([
-                    LightValue.RED_ON,
-                    LightValue.RED_FLASH,
-                    LightValue.RED_FADE
-                ]))
+        ''' Play (beat, type, value) events '''
+        # Beatmaps are timed in beats; the clock counts seconds
+        seconds_per_beat = 60.0 / self.bpm
+        schedule = sorted((
+            (beat * seconds_per_beat, etype, value) for beat, etype, value in events),
+            key=lambda event: event[0])
+
+        lead = self._lead if self.club.config.get('lookahead') else None
+        if self.club.config.get('compile_schedule'):
+            # All the routing and effects work happens up front (or came from the cache)
+            compiled = Schedule.cached(schedule, self.club.lights, self.club.config,
+                self.club.red, self.club.blue, resolution = self.club.renderer.period,
+                balancer = self.club.balancer)
+            logger.info('Compiled %d events into %d light changes', len(schedule), len(compiled))
+
+            self.clock.start(self._song_position() or 0.0)
+            await compiled.play(self.clock, self.club.lights, lead)
+
+        elif lead:
+            # We know what's coming, so send each light its part early enough to land on the beat
+            await self.clock.play_ahead(schedule, self._route,
+                self.club.render_event_for_light,
+                lead)
+        else:
+            await self.clock.play(schedule, self.club.dispatch_map_event)
 
-            events.append({ 'time': note.get('time', 0), 'type': et, 'value': lv })
+        logger.info('Song clock: %s', self.clock.stats())
 
     async def play(self):
         try:
+            beatmap = self.beatmap
+            if not len(beatmap):
+                beatmap = beatmap.emulate()
+            self.plan_balance(beatmap)
+
             mixer.music.play()
-            self.song_time = mixer.music.get_pos()
 
-            await self._simulate(self.beatmap.get('events', []))
+            await self._simulate(beatmap.events())
 
             await self.club.receive_end({})
 
@@ -197,3 +225,121 @@ class Simulation(object):
             mixer.music.stop()
             await self.club.go_ambient()
 
+
+    async def run_headless(self, lights=8):
+        ''' Play the whole map to virtual lights on a virtual clock, as fast as we can, and return statistics '''
+        started = time.perf_counter()
+
+        clock = lambda: self.now
+        renderer = self.club.renderer
+        renderer.clock = clock
+        # Virtual lights run on our virtual clock, so they can't be driven from worker processes
+        self.club.shards = None
+        self.club.set_lights([
+            VirtualLight('virtual-%d' % idx, self.club.config, clock) for idx in range(lights)])
+        await self.club.receive_start(self._start_info())
+
+        beatmap = self.beatmap if len(self.beatmap) else self.beatmap.emulate()
+        events = beatmap.events(seconds_per_beat = 60.0 / self.bpm)
+        self.plan_balance(beatmap)
+
+        frame = 0
+        def render_until(until):
+            nonlocal frame
+            while frame * renderer.period <= until:
+                self.now = frame * renderer.period
+                renderer.tick(self.now)
+                frame += 1
+
+        for at, etype, value in events:
+            render_until(at)
+            self.now = at
+            self.club.dispatch_map_event(etype, value)
+
+        # Let the last effects play out
+        render_until(self.now + 1.0)
+
+        renderer_stats = renderer.stats()
+        light_stats = {light.get_id(): light.stats() for light in self.club.lights}
+        return {
+            'song': self.info.get('songName', self.song_dir),
+            'events': len(events),
+            'duration': events[-1][0] if events else 0.0,
+            'commands': sum(stats['commands'] for stats in light_stats.values()),
+            'suppressed': sum(stats['suppressed'] for stats in light_stats.values()),
+            'peak_rate': max((stats['peak_rate'] for stats in light_stats.values()), default=0.0),
+            'superseded': renderer_stats['cancelled'] + renderer_stats['overwritten'],
+            'lights': light_stats,
+            'balancer': self.club.balancer.stats() if self.club.balancer is not None else None,
+            'elapsed': time.perf_counter() - started,
+        }
+
+
+def find_songs(path):
+    ''' Every level (directory with an info.dat) under path '''
+    if os.path.isfile(path) or os.path.isfile(os.path.join(path, 'info.dat')):
+        return [path]
+
+    songs = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        if any(name.lower() == 'info.dat' for name in files):
+            songs.append(root)
+    return songs
+
+
+async def simulate_headless(path, lights=8):
+    ''' Run every level under path headless, printing statistics as we go '''
+    results = []
+    for song in find_songs(path):
+        try:
+            stats = await Simulation(song, headless = True).run_headless(lights)
+        except Exception as e:
+            logger.warning('Failed to simulate %s: %s', song, e)
+            continue
+
+        print('%-40.40s %6d events %7.1fs  %7d commands  peak %5.1f/s  %6d superseded  (%.2fs)' % (
+            stats['song'], stats['events'], stats['duration'], stats['commands'],
+            stats['peak_rate'], stats['superseded'], stats['elapsed']))
+        results.append(stats)
+    return results
+
+
+async def simulate(args):
+    if args.calibrate:
+        # Calibrating drives the lights directly; no song (or pygame) needed
+        await Club().calibrate()
+        return
+
+    simulation = Simulation(args.song)
+    await simulation.init()
+    if args.demo:
+        await simulation.demo()
+    else:
+        await simulation.play()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play a Beat Saber level on your lights without the game')
+    parser.add_argument('song', nargs='?',
+                        help='A level directory (or its info.dat); headless, a directory of levels')
+    parser.add_argument('--headless', action='store_true',
+                        help='Run on a virtual clock with virtual lights as fast as possible, and report statistics')
+    parser.add_argument('--lights', type=int, default=8,
+                        help='How many virtual lights to use when headless')
+    parser.add_argument('--demo', action='store_true', help='Play a short demo instead of the level')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Measure how fast each light can take commands and save it')
+    args = parser.parse_args()
+    if args.song is None and not args.calibrate:
+        parser.error('a song is needed unless calibrating')
+
+    if args.headless:
+        logging.basicConfig(level=logging.WARNING)
+        asyncio.run(simulate_headless(args.song, args.lights))
+    else:
+        asyncio.run(simulate(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import asyncio
+
+from . import logger
+
+
+class Supervisor(object):
+    ''' Tracks in-flight handler tasks and caps how many may run at once.
+
+    Work marked as sheddable is purely cosmetic lighting work; under overload
+    the oldest sheddable task is cancelled to make room (or the new one is
+    dropped if there is none), while essential work is always admitted. A
+    new task with the same key as a running one replaces it. Failures are
+    logged rather than silently dropped. '''
+
+    def __init__(self, limit=16):
+        self.limit = limit
+
+        # Insertion ordered, so the first sheddable task found is the oldest
+        self.tasks = {}
+        self.keys = {}
+
+        self.completed = 0
+        self.failed = 0
+        self.shed = 0
+
+    def spawn(self, coro, sheddable=False, key=None):
+        ''' Start a task, or return None if it had to be shed straight away '''
+        if key is not None and key in self.keys:
+            self._shed(self.keys[key])
+
+        if len(self.tasks) >= self.limit and not self._shed_oldest() and sheddable:
+            coro.close()
+            self.shed += 1
+            return None
+
+        task = asyncio.create_task(coro)
+        self.tasks[task] = (sheddable, key)
+        if key is not None:
+            self.keys[key] = task
+        task.add_done_callback(self._done)
+        return task
+
+    def _shed_oldest(self):
+        for task, (sheddable, _) in self.tasks.items():
+            if sheddable:
+                self._shed(task)
+                return True
+        return False
+
+    def _shed(self, task):
+        self._forget(task)
+        task.cancel()
+        self.shed += 1
+
+    def _forget(self, task):
+        entry = self.tasks.pop(task, None)
+        if entry is None:
+            return False
+
+        _, key = entry
+        if key is not None and self.keys.get(key) is task:
+            del self.keys[key]
+        return True
+
+    def _done(self, task):
+        if not self._forget(task) or task.cancelled():
+            return
+
+        e = task.exception()
+        if e:
+            self.failed += 1
+            logger.error('Handler failed: %s', e, exc_info=e)
+        else:
+            self.completed += 1
+
+    @property
+    def active(self):
+        return len(self.tasks)
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'completed': self.completed,
+            'failed': self.failed,
+            'shed': self.shed,
+        }
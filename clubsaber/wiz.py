@@ -0,0 +1,215 @@
+import asyncio
+import json
+import time
+
+from . import logger
+from . import metrics
+
+
+PORT = 38899
+
+
+def pilot_matches(intended, actual):
+    ''' Whether a bulb's reported pilot (from getPilot) agrees with what we last asked for '''
+    if not intended.get('state', True):
+        return not actual.get('state', False)
+    if not actual.get('state', False):
+        return False
+
+    for key in ('r', 'g', 'b'):
+        if key in intended and actual.get(key) != intended[key]:
+            return False
+
+    # Bulbs report dimming rounded to their own steps
+    if 'dimming' in intended and abs(actual.get('dimming', 0) - intended['dimming']) > 1:
+        return False
+
+    return True
+
+
+class WizTransport(asyncio.DatagramProtocol):
+    ''' A single UDP endpoint shared by every WiZ bulb.
+
+    Messages are written straight to the socket; everything sent during one
+    pass of the event loop (e.g. one rendered frame) goes out together, and
+    replies are matched back to requests by bulb address and method.
+
+    Bulbs may also be driven fire-and-forget with post(): replies are then
+    only tallied to measure loss, and a background reconciler periodically
+    checks each registered bulb with getPilot and resends its intended state
+    if the bulb disagrees. '''
+
+    _shared = None
+
+    def __init__(self, port=PORT):
+        self.port = port
+        self.transport = None
+
+        self.waiters = {}
+        self.outbox = []
+
+        self.sent = 0
+        self.received = 0
+
+        self.acks = {}
+        self.lights = {}
+        self.reconciler = None
+        self.reconciled = 0
+
+    @classmethod
+    async def shared(cls, port=PORT):
+        if cls._shared is None:
+            cls._shared = asyncio.ensure_future(cls.open(port))
+        return await cls._shared
+
+    @classmethod
+    async def open(cls, port=PORT):
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_datagram_endpoint(
+                lambda: cls(port), local_addr=('0.0.0.0', 0))
+        return protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if WizTransport._shared is not None and WizTransport._shared.done() \
+                and WizTransport._shared.result() is self:
+            WizTransport._shared = None
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        try:
+            message = json.loads(data)
+        except ValueError:
+            logger.debug('Ignoring malformed reply from %s: %r', addr, data)
+            return
+
+        waiters = self.waiters.get(addr[0])
+        if not waiters:
+            return
+
+        method = message.get('method')
+        for idx, (expected, future) in enumerate(waiters):
+            if expected == method and not future.done():
+                del waiters[idx]
+                future.set_result(message)
+                break
+
+    def send(self, ip, message):
+        ''' Queue a message for a bulb; it is written out with the rest of this loop pass '''
+        if not self.outbox:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.outbox.append((ip, json.dumps(message, separators=(',', ':')).encode()))
+
+    def flush(self):
+        outbox, self.outbox = self.outbox, []
+        if self.transport is None:
+            logger.warning('WiZ transport closed; dropping %d messages', len(outbox))
+            return
+
+        for ip, data in outbox:
+            self.transport.sendto(data, (ip, self.port))
+        self.sent += len(outbox)
+
+    def expect(self, ip, method):
+        ''' Return a future for the next reply to method from a bulb '''
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(ip, []).append((method, future))
+        return future
+
+    def forget(self, ip, future):
+        waiters = self.waiters.get(ip)
+        if not waiters:
+            return
+        for idx, (_, waiting) in enumerate(waiters):
+            if waiting is future:
+                del waiters[idx]
+                break
+
+    def post(self, ip, message, timeout=1.0, on_ack=None):
+        ''' Send without waiting for the reply; replies (or their absence) are tallied per bulb.
+        on_ack, if given, is called with the round-trip time when the bulb replies '''
+        acks = self.acks.setdefault(ip, {'posted': 0, 'acked': 0, 'lost': 0})
+        acks['posted'] += 1
+
+        posted = time.monotonic()
+        future = self.expect(ip, message['method'])
+        expiry = asyncio.get_running_loop().call_later(timeout, self._expire, ip, future)
+        future.add_done_callback(lambda f: self._acked(ip, f, expiry, posted, on_ack))
+
+        self.send(ip, message)
+
+    def _acked(self, ip, future, expiry, posted, on_ack):
+        if future.cancelled():
+            return
+        expiry.cancel()
+        self.acks[ip]['acked'] += 1
+
+        rtt = time.monotonic() - posted
+        if metrics.enabled:
+            metrics.observe('ack', rtt)
+        if on_ack is not None:
+            on_ack(rtt)
+
+    def _expire(self, ip, future):
+        if future.done():
+            return
+        self.forget(ip, future)
+        future.cancel()
+        self.acks[ip]['lost'] += 1
+
+    def loss_rate(self, ip):
+        acks = self.acks.get(ip)
+        if not acks or not acks['acked'] + acks['lost']:
+            return 0.0
+        return acks['lost'] / (acks['acked'] + acks['lost'])
+
+    def register(self, light, interval=5.0):
+        ''' Have the reconciler keep an eye on a fire-and-forget light '''
+        self.lights[light.ip] = light
+        if not self.reconciler or self.reconciler.done():
+            self.reconciler = asyncio.create_task(self.reconcile(interval))
+
+    async def reconcile(self, interval):
+        while self.lights:
+            await asyncio.sleep(interval)
+            await asyncio.gather(*[
+                self._reconcile_light(light) for light in tuple(self.lights.values())])
+
+    async def _reconcile_light(self, light):
+        intended = light.intended
+        if intended is None:
+            return
+
+        try:
+            response = await self.request(light.ip, {'method': 'getPilot', 'params': {}})
+        except asyncio.TimeoutError:
+            logger.debug('%s did not answer getPilot', light.ip)
+            return
+
+        # Don't fight an update that went out while we were asking
+        if light.intended is not intended:
+            return
+
+        if not pilot_matches(intended, response.get('result') or {}):
+            logger.debug('%s drifted; resending %s', light.ip, intended)
+            self.reconciled += 1
+            self.post(light.ip, {'method': 'setPilot', 'params': intended})
+
+    async def request(self, ip, message, timeout=1.0, attempts=3):
+        ''' Send a message, resending until the bulb replies or we time out '''
+        future = self.expect(ip, message['method'])
+        try:
+            for _ in range(attempts):
+                self.send(ip, message)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), timeout / attempts)
+                except asyncio.TimeoutError:
+                    continue
+            raise asyncio.TimeoutError('No reply from %s to %s' % (ip, message['method']))
+        finally:
+            if not future.done():
+                future.cancel()
+            self.forget(ip, future)
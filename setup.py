@@ -31,9 +31,15 @@ setup(
         'pywizlight',
         'websockets',
     ],
+    extras_require={
+        'fast': ['orjson'],
+        'hue': ['hue-api', 'httpx'],
+        'simulate': ['pygame', 'numpy'],
+    },
     entry_points={
         'console_scripts': [
             'club_saber = clubsaber.main:main',
+            'club_saber_simulate = clubsaber.simulate:main',
         ],
     },
     options={